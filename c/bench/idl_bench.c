@@ -0,0 +1,115 @@
+/* Copyright 2022 Peter Wagener <mail@peterwagener.net>
+
+This file is part of the Unicorn framework.
+
+Unicorn is free software: you can redistribute it and/or modify it under the
+terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+Unicorn is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+Unicorn. If not, see <https://www.gnu.org/licenses/>.
+*/
+
+// Builds and tears down IDLs with large keyword sets on the heap and in an
+// arena, reporting allocator calls and wall time. Compiled together with
+// unicorn/idl.c so UIDL_MALLOC and friends route through the counters below.
+
+#define _POSIX_C_SOURCE 199309L
+
+#include "unicorn/idl.h"
+
+#include <stdio.h>
+#include <stdlib.h>
+#include <time.h>
+
+static size_t nMalloc  = 0;
+static size_t nRealloc = 0;
+static size_t nFree    = 0;
+
+void *uidl_bench_malloc(size_t size) {
+	nMalloc++;
+	return malloc(size);
+}
+void *uidl_bench_realloc(void *ptr, size_t size) {
+	nRealloc++;
+	return realloc(ptr, size);
+}
+void uidl_bench_free(void *ptr) {
+	nFree++;
+	free(ptr);
+}
+
+static double now() {
+	struct timespec ts;
+	clock_gettime(CLOCK_MONOTONIC, &ts);
+	return (double)ts.tv_sec + (double)ts.tv_nsec * 1e-9;
+}
+
+static void build(unsigned nKeywords) {
+	char ident[32];
+
+	uidl_t *     uidl = uidl_new();
+	uidl_node_t *root = uidl_keyword(NULL, 0);
+	for (unsigned i = 0; i < nKeywords; i++) {
+		snprintf(ident, sizeof(ident), "kw%u", i);
+		uidl_keyword_set(
+			root,
+			ident,
+			uidl_sequence(
+				NULL,
+				2,
+				uidl_string("value", 2, "on", "off"),
+				uidl_integer("n", UIDL_LIMIT_RANGE, 0, 100)));
+	}
+	// overwrite every entry once to exercise the lookup
+	for (unsigned i = 0; i < nKeywords; i++) {
+		snprintf(ident, sizeof(ident), "kw%u", i);
+		uidl_keyword_set(root, ident, uidl_float(NULL, 0, 0, 0));
+	}
+	uidl_set_completion(uidl, root);
+	uidl_set_completion_metadata(uidl, UIDL_COMPL_ADHOC, "out", "err");
+	uidl_free(uidl);
+}
+
+static void run(const char *label, unsigned nKeywords, int useArena) {
+	nMalloc = nRealloc = nFree = 0;
+	double t0 = now();
+
+	uidl_arena_t *arena = NULL;
+	if (useArena) {
+		arena = uidl_arena_new(64 * 1024);
+		uidl_arena_use(arena);
+	}
+	build(nKeywords);
+	if (useArena) {
+		uidl_arena_use(NULL);
+		uidl_arena_free(arena);
+	}
+
+	double t1 = now();
+	printf(
+		"%-6s %7u keywords: %8zu malloc %6zu realloc %8zu free %10.3f ms\n",
+		label,
+		nKeywords,
+		nMalloc,
+		nRealloc,
+		nFree,
+		(t1 - t0) * 1e3);
+}
+
+int main(int argc, char **argv) {
+	unsigned sizes[] = {16, 256, 4096, 32768};
+	(void)argc;
+	(void)argv;
+
+	for (size_t i = 0; i < sizeof(sizes) / sizeof(*sizes); i++) {
+		run("heap", sizes[i], 0);
+		run("arena", sizes[i], 1);
+	}
+	return 0;
+}
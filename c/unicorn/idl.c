@@ -19,11 +19,44 @@ Unicorn. If not, see <https://www.gnu.org/licenses/>.
 
 #include "alpha4c/common/stringbuilder.h"
 #include <stdarg.h>
+#include <stddef.h>
 #include <stdint.h>
 #include <stdio.h>
 #include <stdlib.h>
 #include <string.h>
 
+// allocator hooks, e.g. for RTOS heaps or instrumentation
+#ifndef UIDL_MALLOC
+#define UIDL_MALLOC malloc
+#else
+void *UIDL_MALLOC(size_t size);
+#endif
+#ifndef UIDL_REALLOC
+#define UIDL_REALLOC realloc
+#else
+void *UIDL_REALLOC(void *ptr, size_t size);
+#endif
+#ifndef UIDL_FREE
+#define UIDL_FREE free
+#else
+void UIDL_FREE(void *ptr);
+#endif
+
+#define UIDL_ARENA_ALIGN (_Alignof(max_align_t))
+
+typedef struct uidl_arena_chunk_t uidl_arena_chunk_t;
+typedef struct uidl_arena_chunk_t {
+	uidl_arena_chunk_t *next;
+	size_t              size;
+	size_t              used;
+	max_align_t         data[];
+} uidl_arena_chunk_t;
+
+typedef struct uidl_arena_t {
+	uidl_arena_chunk_t *chunks;
+	size_t              chunkSize;
+} uidl_arena_t;
+
 typedef struct uidl_definition_t uidl_definition_t;
 typedef struct uidl_definition_t {
 	char *             key;
@@ -31,14 +64,40 @@ typedef struct uidl_definition_t {
 	uidl_definition_t *next;
 } uidl_definition_t;
 
+typedef enum uidl_column_type_t {
+	ColumnMeasurement,
+	ColumnKey,
+	ColumnMask,
+	ColumnStates,
+	ColumnNumeric
+} uidl_column_type_t;
+
+typedef struct uidl_column_t {
+	uidl_column_type_t type;
+	char *             name;
+	char *             unit;
+	unsigned           precision;
+	unsigned           count;
+	size_t             nStates;
+	char **            states;
+} uidl_column_t;
+
 typedef struct uidl_t {
-	uidl_node_t *completion;
-	uint32_t     flags;
-	char *       chStdout;
-	char *       chStderr;
+	uidl_arena_t *arena;
+	uidl_node_t * completion;
+	uint32_t      flags;
+	char *        chStdout;
+	char *        chStderr;
 
 	uidl_definition_t *definitions;
 
+	int            isEvent;
+	uint32_t       eventFlags;
+	char *         eventTags;
+	size_t         nColumns;
+	size_t         capColumns;
+	uidl_column_t *columns;
+
 } uidl_t;
 
 typedef enum uidl_type_t {
@@ -83,12 +142,18 @@ typedef struct uidl_sequence_t {
 
 typedef struct uidl_keyword_t {
 	size_t        nPairs;
+	size_t        capacity;
 	uidl_pair_t **pairs;
+	// open addressing index of pairs (pair index + 1, 0 marks an empty bucket),
+	// only built once a keyword holds UIDL_KEYWORD_INDEX_MIN pairs
+	size_t    nBuckets;
+	uint32_t *buckets;
 } uidl_keyword_t;
 
 typedef struct uidl_node_t {
-	uidl_type_t type;
-	char *      id;
+	uidl_arena_t *arena;
+	uidl_type_t   type;
+	char *        id;
 	union {
 		uidl_reference_t reference;
 		uidl_string_t    string;
@@ -101,35 +166,131 @@ typedef struct uidl_node_t {
 } uidl_node_t;
 
 typedef struct uidl_pair_t {
-	char *       ident;
-	uidl_node_t *node;
+	uidl_arena_t *arena;
+	char *        ident;
+	uidl_node_t * node;
 } uidl_pair_t;
 
+#define UIDL_KEYWORD_INDEX_MIN 8
+
+static uidl_arena_t *uidl_current_arena = NULL;
+
+uidl_arena_t *uidl_arena_new(size_t chunkSize) {
+	uidl_arena_t *res = (uidl_arena_t *)UIDL_MALLOC(sizeof(uidl_arena_t));
+	res->chunks       = NULL;
+	res->chunkSize    = chunkSize > 0 ? chunkSize : UIDL_ARENA_CHUNK_SIZE;
+	return res;
+}
+void uidl_arena_free(uidl_arena_t *arena) {
+	if (!arena) return;
+	if (uidl_current_arena == arena) uidl_current_arena = NULL;
+	while (arena->chunks) {
+		uidl_arena_chunk_t *next = arena->chunks->next;
+		UIDL_FREE(arena->chunks);
+		arena->chunks = next;
+	}
+	UIDL_FREE(arena);
+}
+uidl_arena_t *uidl_arena_use(uidl_arena_t *arena) {
+	uidl_arena_t *prev = uidl_current_arena;
+	uidl_current_arena = arena;
+	return prev;
+}
+
+static void *uidl_arena_alloc(uidl_arena_t *arena, size_t size) {
+	size = (size + UIDL_ARENA_ALIGN - 1) / UIDL_ARENA_ALIGN * UIDL_ARENA_ALIGN;
+
+	uidl_arena_chunk_t *chunk = arena->chunks;
+	if (!chunk || chunk->size - chunk->used < size) {
+		size_t chunkSize = size > arena->chunkSize ? size : arena->chunkSize;
+		chunk            = (uidl_arena_chunk_t *)UIDL_MALLOC(
+      sizeof(uidl_arena_chunk_t) + chunkSize);
+		if (!chunk) return NULL;
+		chunk->size = chunkSize;
+		chunk->used = 0;
+		if (arena->chunks && size > arena->chunkSize) {
+			// keep filling the current chunk after an oversized allocation
+			chunk->next         = arena->chunks->next;
+			arena->chunks->next = chunk;
+		} else {
+			chunk->next   = arena->chunks;
+			arena->chunks = chunk;
+		}
+	}
+
+	void *res = (char *)chunk->data + chunk->used;
+	chunk->used += size;
+	return res;
+}
+
+static void *uidl_alloc(uidl_arena_t *arena, size_t size) {
+	if (arena) return uidl_arena_alloc(arena, size);
+	return UIDL_MALLOC(size);
+}
+static void uidl_release(uidl_arena_t *arena, void *ptr) {
+	if (!arena) UIDL_FREE(ptr);
+}
+static char *uidl_strdup(uidl_arena_t *arena, const char *str) {
+	size_t len = strlen(str) + 1;
+	char * res = (char *)uidl_alloc(arena, len);
+	memcpy(res, str, len);
+	return res;
+}
+
 uidl_t *uidl_new() {
-	uidl_t *res      = (uidl_t *)malloc(sizeof(uidl_t));
+	uidl_t *res      = (uidl_t *)uidl_alloc(uidl_current_arena, sizeof(uidl_t));
+	res->arena       = uidl_current_arena;
 	res->completion  = NULL;
+	res->flags       = 0;
 	res->chStdout    = NULL;
 	res->chStderr    = NULL;
 	res->definitions = NULL;
+	res->isEvent     = 0;
+	res->eventFlags  = 0;
+	res->eventTags   = NULL;
+	res->nColumns    = 0;
+	res->capColumns  = 0;
+	res->columns     = NULL;
 	return res;
 }
 void uidl_free(uidl_t *uidl) {
+	if (uidl->arena) return;
 	if (uidl->completion) { uidl_node_free(uidl->completion); }
-	if (uidl->chStdout) free(uidl->chStdout);
-	if (uidl->chStderr) free(uidl->chStderr);
+	if (uidl->chStdout) UIDL_FREE(uidl->chStdout);
+	if (uidl->chStderr) UIDL_FREE(uidl->chStderr);
+	if (uidl->eventTags) UIDL_FREE(uidl->eventTags);
+
+	for (size_t i = 0; i < uidl->nColumns; i++) {
+		uidl_column_t *col = &uidl->columns[i];
+		UIDL_FREE(col->name);
+		if (col->unit) UIDL_FREE(col->unit);
+		for (size_t j = 0; j < col->nStates; j++) UIDL_FREE(col->states[j]);
+		if (col->states) UIDL_FREE(col->states);
+	}
+	if (uidl->columns) UIDL_FREE(uidl->columns);
 
 	while (uidl->definitions) {
 		uidl_definition_t *next = uidl->definitions->next;
-		free(uidl->definitions->key);
+		UIDL_FREE(uidl->definitions->key);
 		uidl_node_free(uidl->definitions->node);
-		free(uidl->definitions);
+		UIDL_FREE(uidl->definitions);
 		uidl->definitions = next;
 	}
 
-	free(uidl);
+	UIDL_FREE(uidl);
+}
+
+// the schema accepts exactly one of completion, measurement and event, so
+// setters refuse to mix them
+static int uidl_has_data(uidl_t *uidl) {
+	return uidl->isEvent || uidl->nColumns > 0;
 }
 
 void uidl_set_completion(uidl_t *uidl, uidl_node_t *node) {
+	if (node && uidl_has_data(uidl)) {
+		uidl_node_free(node);
+		return;
+	}
 	if (uidl->completion) { uidl_node_free(uidl->completion); }
 
 	uidl->completion = node;
@@ -137,12 +298,12 @@ void uidl_set_completion(uidl_t *uidl, uidl_node_t *node) {
 
 void uidl_set_completion_metadata(
 	uidl_t *uidl, unsigned flags, const char *chStdout, const char *chStderr) {
-	if (uidl->chStdout) free(uidl->chStdout);
-	if (uidl->chStderr) free(uidl->chStderr);
+	if (uidl->chStdout) uidl_release(uidl->arena, uidl->chStdout);
+	if (uidl->chStderr) uidl_release(uidl->arena, uidl->chStderr);
 
 	uidl->flags    = flags;
-	uidl->chStdout = chStdout ? strdup(chStdout) : NULL;
-	uidl->chStderr = chStderr ? strdup(chStderr) : NULL;
+	uidl->chStdout = chStdout ? uidl_strdup(uidl->arena, chStdout) : NULL;
+	uidl->chStderr = chStderr ? uidl_strdup(uidl->arena, chStderr) : NULL;
 }
 
 void uidl_set_definition(uidl_t *uidl, const char *key, uidl_node_t *node) {
@@ -157,91 +318,134 @@ void uidl_set_definition(uidl_t *uidl, const char *key, uidl_node_t *node) {
 		pdef = &(**pdef).next;
 	}
 
-	*pdef         = (uidl_definition_t *)malloc(sizeof(uidl_definition_t));
-	(*pdef)->key  = strdup(key);
+	*pdef = (uidl_definition_t *)uidl_alloc(
+		uidl->arena, sizeof(uidl_definition_t));
+	(*pdef)->key  = uidl_strdup(uidl->arena, key);
 	(*pdef)->node = node;
 	(*pdef)->next = NULL;
 }
 
-void uidl_to_json(uidl_t *uidl, sbuilder_t *sb) {
-	int first = 1;
-#define HANDLEFIRST \
-	if (first)        \
-		first = 0;      \
-	else              \
-		sbuilder_append(sb, ",");
+static uidl_column_t *
+uidl_add_column(uidl_t *uidl, uidl_column_type_t type, const char *name) {
+	if (uidl->completion || !name) return NULL;
+	// measurement columns only go with other measurement columns
+	if (type == ColumnMeasurement ? uidl->isEvent
+	                              : uidl->nColumns > 0 && !uidl->isEvent)
+		return NULL;
+	if (uidl->nColumns >= uidl->capColumns) {
+		size_t         capacity = uidl->capColumns > 0 ? uidl->capColumns * 2 : 4;
+		uidl_column_t *pnew;
+		if (uidl->arena) {
+			pnew = (uidl_column_t *)uidl_alloc(
+				uidl->arena, sizeof(uidl_column_t) * capacity);
+			if (pnew && uidl->nColumns > 0)
+				memcpy(pnew, uidl->columns, sizeof(uidl_column_t) * uidl->nColumns);
+		} else {
+			pnew = (uidl_column_t *)UIDL_REALLOC(
+				(void *)uidl->columns, sizeof(uidl_column_t) * capacity);
+		}
+		if (!pnew) return NULL;
+		uidl->columns    = pnew;
+		uidl->capColumns = capacity;
+	}
 
-	sbuilder_append(sb, "{");
+	uidl_column_t *col = &uidl->columns[uidl->nColumns++];
+	col->type          = type;
+	col->name          = uidl_strdup(uidl->arena, name);
+	col->unit          = NULL;
+	col->precision     = 0;
+	col->count         = 0;
+	col->nStates       = 0;
+	col->states        = NULL;
+	return col;
+}
 
-	if (uidl->flags & UIDL_COMPL_FLAT) {
-		HANDLEFIRST
-		sbuilder_append(sb, "\"flat\":true");
-	}
-	if (uidl->flags & UIDL_COMPL_ADHOC) {
-		HANDLEFIRST
-		sbuilder_append(sb, "\"adHocChannels\":true");
-	}
-	if (uidl->chStdout) {
-		HANDLEFIRST
-		sbuilder_sprintf(sb, "\"stdout\":\"%s\"", uidl->chStdout);
-	}
-	if (uidl->chStderr) {
-		HANDLEFIRST
-		sbuilder_sprintf(sb, "\"stderr\":\"%s\"", uidl->chStderr);
-	}
+void uidl_add_measurement(
+	uidl_t *uidl, const char *name, const char *unit, unsigned precision) {
+	uidl_column_t *col = uidl_add_column(uidl, ColumnMeasurement, name);
+	if (!col) return;
+	col->unit      = uidl_strdup(uidl->arena, unit ? unit : "");
+	col->precision = precision;
+}
 
-	if (uidl->completion) {
-		HANDLEFIRST
-		sbuilder_append(sb, "\"completion\":");
-		uidl_node_to_json(uidl->completion, sb);
-	}
+void uidl_set_event(uidl_t *uidl, const char *tags, unsigned flags) {
+	if (uidl->completion || (uidl->nColumns > 0 && !uidl->isEvent)) return;
+	if (uidl->eventTags) uidl_release(uidl->arena, uidl->eventTags);
 
-	if (uidl->definitions) {
-		HANDLEFIRST
-		sbuilder_append(sb, "\"definitions\":{");
-		int first1 = 1;
-		for (uidl_definition_t *def = uidl->definitions; def; def = def->next) {
-			if (first1) {
-				first1 = 0;
-			} else {
-				sbuilder_append(sb, ",");
-			}
-			sbuilder_sprintf(sb, "\"%s\":", def->key);
-			uidl_node_to_json(def->node, sb);
+	uidl->isEvent    = 1;
+	uidl->eventFlags = flags;
+	uidl->eventTags  = tags ? uidl_strdup(uidl->arena, tags) : NULL;
+}
+void uidl_add_event_key(uidl_t *uidl, const char *name, unsigned count) {
+	uidl_column_t *col = uidl_add_column(uidl, ColumnKey, name);
+	if (!col) return;
+	uidl->isEvent = 1;
+	col->count    = count;
+}
+void uidl_add_event_mask(uidl_t *uidl, const char *name, unsigned count) {
+	uidl_column_t *col = uidl_add_column(uidl, ColumnMask, name);
+	if (!col) return;
+	uidl->isEvent = 1;
+	col->count    = count;
+}
+void uidl_add_event_states(
+	uidl_t *uidl, const char *name, unsigned nStates, ...) {
+	uidl_column_t *col = uidl_add_column(uidl, ColumnStates, name);
+	if (!col) return;
+	uidl->isEvent = 1;
+	col->nStates  = nStates;
+	if (nStates > 0) {
+		col->states = (char **)uidl_alloc(uidl->arena, sizeof(char *) * nStates);
+		va_list states;
+		va_start(states, nStates);
+		for (unsigned i = 0; i < nStates; i++) {
+			col->states[i] = uidl_strdup(uidl->arena, va_arg(states, const char *));
 		}
-		sbuilder_append(sb, "}");
+		va_end(states);
 	}
-
-#undef HANDLEFIRST
-
-	sbuilder_append(sb, "}");
+}
+void uidl_add_event_numeric(
+	uidl_t *uidl, const char *name, unsigned precision) {
+	uidl_column_t *col = uidl_add_column(uidl, ColumnNumeric, name);
+	if (!col) return;
+	uidl->isEvent  = 1;
+	col->precision = precision;
 }
 
 uidl_pair_t *uidl_pair(const char *key, uidl_node_t *node) {
-	uidl_pair_t *res = (uidl_pair_t *)malloc(sizeof(uidl_pair_t));
-	res->ident       = strdup(key);
-	res->node        = node;
+	uidl_arena_t *arena = uidl_current_arena;
+	uidl_pair_t * res   = (uidl_pair_t *)uidl_alloc(arena, sizeof(uidl_pair_t));
+	res->arena          = arena;
+	res->ident          = uidl_strdup(arena, key);
+	res->node           = node;
+	return res;
+}
+
+static uidl_node_t *uidl_node_new(uidl_type_t type, const char *id) {
+	uidl_arena_t *arena = uidl_current_arena;
+	uidl_node_t * res   = (uidl_node_t *)uidl_alloc(arena, sizeof(uidl_node_t));
+	res->arena          = arena;
+	res->type           = type;
+	res->id             = id ? uidl_strdup(arena, id) : NULL;
 	return res;
 }
 
 uidl_node_t *uidl_reference(const char *id) {
-	uidl_node_t *res        = (uidl_node_t *)malloc(sizeof(uidl_node_t));
-	res->type               = Reference;
-	res->reference.targetID = strdup(id);
-	res->id                 = NULL;
+	uidl_node_t *res        = uidl_node_new(Reference, NULL);
+	res->reference.targetID = uidl_strdup(res->arena, id);
 	return res;
 }
 uidl_node_t *uidl_string(const char *id, unsigned nOptions, ...) {
-	uidl_node_t *res     = (uidl_node_t *)malloc(sizeof(uidl_node_t));
-	res->type            = String;
-	res->id              = id ? strdup(id) : NULL;
+	uidl_node_t *res     = uidl_node_new(String, id);
 	res->string.nOptions = nOptions;
 	if (nOptions > 0) {
-		res->string.options = (char **)malloc(sizeof(char *) * nOptions);
+		res->string.options =
+			(char **)uidl_alloc(res->arena, sizeof(char *) * nOptions);
 		va_list options;
 		va_start(options, nOptions);
 		for (unsigned i = 0; i < nOptions; i++) {
-			res->string.options[i] = strdup(va_arg(options, const char *));
+			res->string.options[i] =
+				uidl_strdup(res->arena, va_arg(options, const char *));
 		}
 		va_end(options);
 	} else {
@@ -251,9 +455,7 @@ uidl_node_t *uidl_string(const char *id, unsigned nOptions, ...) {
 }
 uidl_node_t *
 uidl_float(const char *id, unsigned flags, double min, double max) {
-	uidl_node_t *res  = (uidl_node_t *)malloc(sizeof(uidl_node_t));
-	res->type         = Float;
-	res->id           = id ? strdup(id) : NULL;
+	uidl_node_t *res  = uidl_node_new(Float, id);
 	res->number.flags = flags;
 	res->number.min   = min;
 	res->number.max   = max;
@@ -261,9 +463,7 @@ uidl_float(const char *id, unsigned flags, double min, double max) {
 }
 uidl_node_t *
 uidl_integer(const char *id, unsigned flags, long long min, long long max) {
-	uidl_node_t *res   = (uidl_node_t *)malloc(sizeof(uidl_node_t));
-	res->type          = Integer;
-	res->id            = id ? strdup(id) : NULL;
+	uidl_node_t *res   = uidl_node_new(Integer, id);
 	res->integer.flags = flags;
 	res->integer.min   = min;
 	res->integer.max   = max;
@@ -271,17 +471,17 @@ uidl_integer(const char *id, unsigned flags, long long min, long long max) {
 }
 uidl_node_t *
 uidl_repeat(const char *id, uidl_node_t *subject, unsigned nEndings, ...) {
-	uidl_node_t *res     = (uidl_node_t *)malloc(sizeof(uidl_node_t));
-	res->type            = Repeat;
-	res->id              = id ? strdup(id) : NULL;
+	uidl_node_t *res     = uidl_node_new(Repeat, id);
 	res->repeat.subject  = subject;
 	res->repeat.nEndings = nEndings;
 	if (nEndings > 0) {
-		res->repeat.endings = (char **)malloc(sizeof(char *) * nEndings);
+		res->repeat.endings =
+			(char **)uidl_alloc(res->arena, sizeof(char *) * nEndings);
 		va_list endings;
 		va_start(endings, nEndings);
 		for (unsigned i = 0; i < nEndings; i++) {
-			res->repeat.endings[i] = strdup(va_arg(endings, const char *));
+			res->repeat.endings[i] =
+				uidl_strdup(res->arena, va_arg(endings, const char *));
 		}
 		va_end(endings);
 	} else {
@@ -290,12 +490,11 @@ uidl_repeat(const char *id, uidl_node_t *subject, unsigned nEndings, ...) {
 	return res;
 }
 uidl_node_t *uidl_sequence(const char *id, unsigned count, ...) {
-	uidl_node_t *res     = (uidl_node_t *)malloc(sizeof(uidl_node_t));
-	res->type            = Sequence;
-	res->id              = id ? strdup(id) : NULL;
+	uidl_node_t *res     = uidl_node_new(Sequence, id);
 	res->sequence.nNodes = count;
 	if (count > 0) {
-		res->sequence.nodes = (uidl_node_t **)malloc(sizeof(uidl_node_t *) * count);
+		res->sequence.nodes =
+			(uidl_node_t **)uidl_alloc(res->arena, sizeof(uidl_node_t *) * count);
 		va_list nodes;
 		va_start(nodes, count);
 		for (unsigned i = 0; i < count; i++) {
@@ -307,60 +506,132 @@ uidl_node_t *uidl_sequence(const char *id, unsigned count, ...) {
 	}
 	return res;
 }
+
+static uint32_t uidl_hash(const char *str) {
+	// FNV-1a
+	uint32_t res = 2166136261u;
+	for (; *str; str++) {
+		res ^= (uint8_t)*str;
+		res *= 16777619u;
+	}
+	return res;
+}
+
+static void uidl_keyword_index(uidl_node_t *node) {
+	uidl_keyword_t *kw = &node->keyword;
+
+	size_t nBuckets = kw->nBuckets > 0 ? kw->nBuckets : 16;
+	while (nBuckets < kw->nPairs * 2) nBuckets *= 2;
+
+	if (nBuckets != kw->nBuckets) {
+		if (kw->buckets) uidl_release(node->arena, kw->buckets);
+		kw->buckets =
+			(uint32_t *)uidl_alloc(node->arena, sizeof(uint32_t) * nBuckets);
+		kw->nBuckets = nBuckets;
+	}
+	memset(kw->buckets, 0, sizeof(uint32_t) * nBuckets);
+
+	for (size_t i = 0; i < kw->nPairs; i++) {
+		size_t bucket = uidl_hash(kw->pairs[i]->ident) & (nBuckets - 1);
+		while (kw->buckets[bucket]) bucket = (bucket + 1) & (nBuckets - 1);
+		kw->buckets[bucket] = (uint32_t)(i + 1);
+	}
+}
+
+static uidl_pair_t **uidl_keyword_find(uidl_node_t *node, const char *ident) {
+	uidl_keyword_t *kw = &node->keyword;
+	if (kw->nBuckets > 0) {
+		size_t bucket = uidl_hash(ident) & (kw->nBuckets - 1);
+		for (; kw->buckets[bucket]; bucket = (bucket + 1) & (kw->nBuckets - 1)) {
+			uidl_pair_t **pair = &kw->pairs[kw->buckets[bucket] - 1];
+			if (strcmp((*pair)->ident, ident) == 0) return pair;
+		}
+		return NULL;
+	}
+	for (size_t i = 0; i < kw->nPairs; i++) {
+		if (strcmp(kw->pairs[i]->ident, ident) == 0) return &kw->pairs[i];
+	}
+	return NULL;
+}
+
 uidl_node_t *uidl_keyword(const char *id, unsigned count, ...) {
-	uidl_node_t *res    = (uidl_node_t *)malloc(sizeof(uidl_node_t));
-	res->type           = Keyword;
-	res->id             = id ? strdup(id) : NULL;
-	res->keyword.nPairs = count;
+	uidl_node_t *res      = uidl_node_new(Keyword, id);
+	res->keyword.nPairs   = count;
+	res->keyword.capacity = count;
+	res->keyword.nBuckets = 0;
+	res->keyword.buckets  = NULL;
 	if (count > 0) {
-		res->keyword.pairs = (uidl_pair_t **)malloc(sizeof(uidl_pair_t *) * count);
+		res->keyword.pairs =
+			(uidl_pair_t **)uidl_alloc(res->arena, sizeof(uidl_pair_t *) * count);
 		va_list pairs;
 		va_start(pairs, count);
 		for (unsigned i = 0; i < count; i++) {
 			res->keyword.pairs[i] = va_arg(pairs, uidl_pair_t *);
 		}
 		va_end(pairs);
+		if (count >= UIDL_KEYWORD_INDEX_MIN) uidl_keyword_index(res);
 	} else {
 		res->keyword.pairs = NULL;
 	}
 	return res;
 }
+uidl_node_t *uidl_keyword_get(uidl_node_t *node, const char *ident) {
+	uidl_pair_t **pair = uidl_keyword_find(node, ident);
+	return pair ? (*pair)->node : NULL;
+}
 void uidl_keyword_set(uidl_node_t *node, const char *ident, uidl_node_t *stmt) {
-	if (!node->keyword.pairs) {
-		node->keyword.nPairs   = 1;
-		node->keyword.pairs    = (uidl_pair_t **)malloc(sizeof(uidl_pair_t *));
-		node->keyword.pairs[0] = uidl_pair(ident, stmt);
-	} else {
-		for (size_t i = 0; i < node->keyword.nPairs; i++) {
-			if (strcmp(node->keyword.pairs[i]->ident, ident) == 0) {
-				uidl_node_free(node->keyword.pairs[i]->node);
-				node->keyword.pairs[i]->node = stmt;
-				return;
-			}
-		}
-		{
-			node->keyword.nPairs++;
-			uidl_pair_t **pnew = (uidl_pair_t **)realloc(
-				(void *)node->keyword.pairs,
-				sizeof(uidl_pair_t *) * node->keyword.nPairs);
-			if (pnew) node->keyword.pairs = pnew;
+	uidl_keyword_t *kw   = &node->keyword;
+	uidl_pair_t **  pair = uidl_keyword_find(node, ident);
+	if (pair) {
+		uidl_node_free((*pair)->node);
+		(*pair)->node = stmt;
+		return;
+	}
+
+	if (kw->nPairs >= kw->capacity) {
+		size_t        capacity = kw->capacity > 0 ? kw->capacity * 2 : 4;
+		uidl_pair_t **pnew;
+		if (node->arena) {
+			pnew = (uidl_pair_t **)uidl_alloc(
+				node->arena, sizeof(uidl_pair_t *) * capacity);
+			if (pnew && kw->nPairs > 0)
+				memcpy(pnew, kw->pairs, sizeof(uidl_pair_t *) * kw->nPairs);
+		} else {
+			pnew = (uidl_pair_t **)UIDL_REALLOC(
+				(void *)kw->pairs, sizeof(uidl_pair_t *) * capacity);
 		}
+		if (!pnew) return;
+		kw->pairs    = pnew;
+		kw->capacity = capacity;
+	}
 
-		node->keyword.pairs[node->keyword.nPairs - 1] = uidl_pair(ident, stmt);
+	{
+		uidl_arena_t *prev = uidl_arena_use(node->arena);
+		kw->pairs[kw->nPairs++] = uidl_pair(ident, stmt);
+		uidl_arena_use(prev);
+	}
+
+	if (kw->nBuckets > 0 && kw->nPairs * 2 <= kw->nBuckets) {
+		size_t bucket = uidl_hash(ident) & (kw->nBuckets - 1);
+		while (kw->buckets[bucket]) bucket = (bucket + 1) & (kw->nBuckets - 1);
+		kw->buckets[bucket] = (uint32_t)kw->nPairs;
+	} else if (kw->nPairs >= UIDL_KEYWORD_INDEX_MIN) {
+		uidl_keyword_index(node);
 	}
 }
 
 void uidl_node_free(uidl_node_t *node) {
 	if (!node) return;
+	if (node->arena) return;
 
 	switch (node->type) {
-		case Reference: free(node->reference.targetID); break;
+		case Reference: UIDL_FREE(node->reference.targetID); break;
 		case String:
 
 			if (node->string.nOptions > 0) {
 				for (size_t i = 0; i < node->string.nOptions; i++)
-					free(node->string.options[i]);
-				free(node->string.options);
+					UIDL_FREE(node->string.options[i]);
+				UIDL_FREE(node->string.options);
 			}
 			break;
 		case Float: break;
@@ -370,9 +641,9 @@ void uidl_node_free(uidl_node_t *node) {
 
 			if (node->repeat.nEndings > 0) {
 				for (size_t i = 0; i < node->repeat.nEndings; i++) {
-					free(node->repeat.endings[i]);
+					UIDL_FREE(node->repeat.endings[i]);
 				}
-				free(node->repeat.endings);
+				UIDL_FREE(node->repeat.endings);
 			}
 			break;
 		case Sequence:
@@ -381,7 +652,7 @@ void uidl_node_free(uidl_node_t *node) {
 				for (size_t i = 0; i < node->sequence.nNodes; i++) {
 					uidl_node_free(node->sequence.nodes[i]);
 				}
-				free(node->sequence.nodes);
+				UIDL_FREE(node->sequence.nodes);
 			}
 			break;
 		case Keyword:
@@ -390,127 +661,500 @@ void uidl_node_free(uidl_node_t *node) {
 				for (size_t i = 0; i < node->keyword.nPairs; i++) {
 					uidl_pair_free(node->keyword.pairs[i]);
 				}
-				free(node->keyword.pairs);
 			}
+			if (node->keyword.pairs) UIDL_FREE(node->keyword.pairs);
+			if (node->keyword.buckets) UIDL_FREE(node->keyword.buckets);
 			break;
 	}
 
-	if (node->id) free(node->id);
-	free(node);
+	if (node->id) UIDL_FREE(node->id);
+	UIDL_FREE(node);
 }
 
 void uidl_pair_free(uidl_pair_t *pair) {
-	free(pair->ident);
+	if (pair->arena) return;
+	UIDL_FREE(pair->ident);
 	uidl_node_free(pair->node);
-	free(pair);
+	UIDL_FREE(pair);
 }
 
-void uidl_node_to_json(uidl_node_t *node, sbuilder_t *sb) {
+typedef struct uidl_emitter_t {
+	uidl_write_t write;
+	void *       ctx;
+} uidl_emitter_t;
+
+static void uidl_emit(uidl_emitter_t *em, const char *str) {
+	em->write(em->ctx, str, strlen(str));
+}
+
+static void uidl_emit_string(uidl_emitter_t *em, const char *str) {
+	const char *run = str;
+	em->write(em->ctx, "\"", 1);
+	for (; *str; str++) {
+		char esc[7];
+		if (*str == '"' || *str == '\\') {
+			esc[0] = '\\';
+			esc[1] = *str;
+			esc[2] = 0;
+		} else if ((unsigned char)*str < 0x20) {
+			snprintf(esc, sizeof(esc), "\\u%04x", (unsigned)*str);
+		} else {
+			continue;
+		}
+		if (str > run) em->write(em->ctx, run, (size_t)(str - run));
+		uidl_emit(em, esc);
+		run = str + 1;
+	}
+	if (str > run) em->write(em->ctx, run, (size_t)(str - run));
+	em->write(em->ctx, "\"", 1);
+}
+
+static void uidl_emit_key(uidl_emitter_t *em, const char *key) {
+	uidl_emit_string(em, key);
+	em->write(em->ctx, ":", 1);
+}
+
+static void uidl_emit_float(uidl_emitter_t *em, double value) {
+	char buf[32];
+	// %f of huge magnitudes runs into hundreds of digits
+	if (value > -1e15 && value < 1e15) {
+		snprintf(buf, sizeof(buf), "%f", value);
+	} else {
+		snprintf(buf, sizeof(buf), "%.17g", value);
+	}
+	uidl_emit(em, buf);
+}
+
+static void uidl_emit_integer(uidl_emitter_t *em, long long value) {
+	char buf[24];
+	snprintf(buf, sizeof(buf), "%lli", value);
+	uidl_emit(em, buf);
+}
+
+static void uidl_emit_node(uidl_emitter_t *em, uidl_node_t *node) {
 	if (!node) {
-		sbuilder_append(sb, "null");
+		uidl_emit(em, "null");
 		return;
 	}
-	sbuilder_append(sb, "{");
+	uidl_emit(em, "{");
 	switch (node->type) {
 		case Reference:
-			sbuilder_sprintf(
-				sb, "\"type\":\"reference\",\"ref\":\"%s\"", node->reference.targetID);
+			uidl_emit(em, "\"type\":\"reference\",\"ref\":");
+			uidl_emit_string(em, node->reference.targetID);
 			break;
 
 		case String:
-			sbuilder_append(sb, "\"type\":\"string\",\"options\":[");
+			uidl_emit(em, "\"type\":\"string\",\"options\":[");
 			if (node->string.options) {
-				int first = 1;
 				for (size_t i = 0; i < node->string.nOptions; i++) {
-					if (first) {
-						first = 0;
-					} else {
-						sbuilder_append(sb, ",");
-					}
-					sbuilder_sprintf(sb, "\"%s\"", node->string.options[i]);
+					if (i > 0) uidl_emit(em, ",");
+					uidl_emit_string(em, node->string.options[i]);
 				}
 			}
-			sbuilder_append(sb, "]");
+			uidl_emit(em, "]");
 			break;
 
 		case Float:
-			sbuilder_append(sb, "\"type\":\"number\",\"integer\":false");
+			uidl_emit(em, "\"type\":\"number\",\"integer\":false");
 			if (node->number.flags & UIDL_LIMIT_LOWER) {
-				sbuilder_sprintf(sb, ",\"min\":%f", node->number.min);
+				uidl_emit(em, ",\"min\":");
+				uidl_emit_float(em, node->number.min);
 			}
 			if (node->number.flags & UIDL_LIMIT_UPPER) {
-				sbuilder_sprintf(sb, ",\"max\":%f", node->number.max);
+				uidl_emit(em, ",\"max\":");
+				uidl_emit_float(em, node->number.max);
 			}
 			break;
 
 		case Integer:
-			sbuilder_append(sb, "\"type\":\"number\",\"integer\":true");
+			uidl_emit(em, "\"type\":\"number\",\"integer\":true");
 			if (node->integer.flags & UIDL_LIMIT_LOWER) {
-				sbuilder_sprintf(sb, ",\"min\":%lli", node->integer.min);
+				uidl_emit(em, ",\"min\":");
+				uidl_emit_integer(em, node->integer.min);
 			}
 			if (node->integer.flags & UIDL_LIMIT_UPPER) {
-				sbuilder_sprintf(sb, ",\"max\":%lli", node->integer.max);
+				uidl_emit(em, ",\"max\":");
+				uidl_emit_integer(em, node->integer.max);
 			}
 			break;
 
 		case Repeat:
-			sbuilder_append(sb, "\"type\":\"repeat\",\"stmt\":");
-			uidl_node_to_json(node->repeat.subject, sb);
+			uidl_emit(em, "\"type\":\"repeat\",\"stmt\":");
+			uidl_emit_node(em, node->repeat.subject);
 
 			if (node->repeat.nEndings == 1) {
-				sbuilder_sprintf(sb, ",\"end\":\"%s\"", node->repeat.endings[0]);
+				uidl_emit(em, ",\"end\":");
+				uidl_emit_string(em, node->repeat.endings[0]);
 			} else if (node->repeat.nEndings > 0) {
-				sbuilder_append(sb, ",\"end\":[");
-				int first = 1;
+				uidl_emit(em, ",\"end\":[");
 				for (size_t i = 0; i < node->repeat.nEndings; i++) {
-					if (first) {
-						first = 0;
-					} else {
-						sbuilder_append(sb, ",");
-					}
-					sbuilder_sprintf(sb, "\"%s\"", node->repeat.endings[i]);
+					if (i > 0) uidl_emit(em, ",");
+					uidl_emit_string(em, node->repeat.endings[i]);
 				}
-				sbuilder_append(sb, "]");
+				uidl_emit(em, "]");
 			}
 			break;
 
-		case Sequence: {
-			sbuilder_append(sb, "\"type\":\"sequence\",\"stmts\":[");
+		case Sequence:
+			uidl_emit(em, "\"type\":\"sequence\",\"stmts\":[");
 			if (node->sequence.nodes) {
-				int first = 1;
 				for (size_t i = 0; i < node->sequence.nNodes; i++) {
-					if (first) {
-						first = 0;
-					} else {
-						sbuilder_append(sb, ",");
-					}
-
-					uidl_node_to_json(node->sequence.nodes[i], sb);
+					if (i > 0) uidl_emit(em, ",");
+					uidl_emit_node(em, node->sequence.nodes[i]);
 				}
 			}
-			sbuilder_append(sb, "]");
+			uidl_emit(em, "]");
 			break;
-		}
 
-		case Keyword: {
-			sbuilder_append(sb, "\"type\":\"keyword\",\"stmts\":{");
+		case Keyword:
+			uidl_emit(em, "\"type\":\"keyword\",\"stmts\":{");
 			if (node->keyword.pairs) {
-				int first = 1;
 				for (size_t i = 0; i < node->keyword.nPairs; i++) {
-					if (first) {
-						first = 0;
-					} else {
-						sbuilder_append(sb, ",");
-					}
-					sbuilder_sprintf(sb, "\"%s\":", node->keyword.pairs[i]->ident);
-					uidl_node_to_json(node->keyword.pairs[i]->node, sb);
+					if (i > 0) uidl_emit(em, ",");
+					uidl_emit_key(em, node->keyword.pairs[i]->ident);
+					uidl_emit_node(em, node->keyword.pairs[i]->node);
 				}
 			}
-			sbuilder_append(sb, "}");
+			uidl_emit(em, "}");
 			break;
+	}
+
+	if (node->id) {
+		uidl_emit(em, ",\"id\":");
+		uidl_emit_string(em, node->id);
+	}
+	uidl_emit(em, "}");
+}
+
+static void uidl_emit_uidl(uidl_emitter_t *em, uidl_t *uidl) {
+	int first = 1;
+#define HANDLEFIRST \
+	if (first)        \
+		first = 0;      \
+	else              \
+		uidl_emit(em, ",");
+
+	uidl_emit(em, "{");
+
+	if (uidl->flags & UIDL_COMPL_FLAT) {
+		HANDLEFIRST
+		uidl_emit(em, "\"flat\":true");
+	}
+	if (uidl->flags & UIDL_COMPL_ADHOC) {
+		HANDLEFIRST
+		uidl_emit(em, "\"adHocChannels\":true");
+	}
+	if (uidl->chStdout) {
+		HANDLEFIRST
+		uidl_emit_key(em, "stdout");
+		uidl_emit_string(em, uidl->chStdout);
+	}
+	if (uidl->chStderr) {
+		HANDLEFIRST
+		uidl_emit_key(em, "stderr");
+		uidl_emit_string(em, uidl->chStderr);
+	}
+
+	if (uidl->completion) {
+		HANDLEFIRST
+		uidl_emit(em, "\"completion\":");
+		uidl_emit_node(em, uidl->completion);
+	}
+
+	if (uidl->definitions) {
+		HANDLEFIRST
+		uidl_emit(em, "\"definitions\":{");
+		for (uidl_definition_t *def = uidl->definitions; def; def = def->next) {
+			if (def != uidl->definitions) uidl_emit(em, ",");
+			uidl_emit_key(em, def->key);
+			uidl_emit_node(em, def->node);
 		}
+		uidl_emit(em, "}");
 	}
 
-	if (node->id) { sbuilder_sprintf(sb, ",\"id\":\"%s\"", node->id); }
-	sbuilder_append(sb, "}");
-}
\ No newline at end of file
+	if (uidl->isEvent) {
+		HANDLEFIRST
+		uidl_emit(em, "\"event\":{");
+		int first1 = 1;
+		if (uidl->eventTags) {
+			first1 = 0;
+			uidl_emit_key(em, "tags");
+			uidl_emit_string(em, uidl->eventTags);
+		}
+		if (uidl->nColumns > 0) {
+			if (!first1) uidl_emit(em, ",");
+			first1 = 0;
+			uidl_emit(em, "\"columns\":[");
+			for (size_t i = 0; i < uidl->nColumns; i++) {
+				uidl_column_t *col = &uidl->columns[i];
+				if (i > 0) uidl_emit(em, ",");
+				uidl_emit(em, "{\"name\":");
+				uidl_emit_string(em, col->name);
+				switch (col->type) {
+					case ColumnKey:
+						uidl_emit(em, ",\"type\":\"key\",\"count\":");
+						uidl_emit_integer(em, col->count);
+						break;
+					case ColumnMask:
+						uidl_emit(em, ",\"type\":\"mask\",\"count\":");
+						uidl_emit_integer(em, col->count);
+						break;
+					case ColumnStates:
+						uidl_emit(em, ",\"type\":\"states\",\"states\":[");
+						for (size_t j = 0; j < col->nStates; j++) {
+							if (j > 0) uidl_emit(em, ",");
+							uidl_emit_string(em, col->states[j]);
+						}
+						uidl_emit(em, "]");
+						break;
+					default: uidl_emit(em, ",\"type\":\"numeric\""); break;
+				}
+				uidl_emit(em, "}");
+			}
+			uidl_emit(em, "]");
+		}
+		if (uidl->eventFlags & UIDL_EVENT_DISREGARD_REPEATED) {
+			if (!first1) uidl_emit(em, ",");
+			uidl_emit(em, "\"disregard_repeated\":true");
+		}
+		uidl_emit(em, "}");
+	} else if (uidl->nColumns > 0) {
+		HANDLEFIRST
+		uidl_emit(em, "\"measurement\":[");
+		for (size_t i = 0; i < uidl->nColumns; i++) {
+			if (i > 0) uidl_emit(em, ",");
+			uidl_emit(em, "{\"name\":");
+			uidl_emit_string(em, uidl->columns[i].name);
+			uidl_emit(em, ",\"unit\":");
+			uidl_emit_string(em, uidl->columns[i].unit);
+			uidl_emit(em, "}");
+		}
+		uidl_emit(em, "]");
+	}
+
+#undef HANDLEFIRST
+
+	uidl_emit(em, "}");
+}
+
+// fragments are batched into terminated chunks for sbuilder_append, one
+// append per chunk and no format string parsed per token
+#ifndef UIDL_SBUILDER_CHUNK_SIZE
+#define UIDL_SBUILDER_CHUNK_SIZE 256
+#endif
+
+typedef struct uidl_sbuilder_writer_t {
+	sbuilder_t *sb;
+	size_t      used;
+	char        chunk[UIDL_SBUILDER_CHUNK_SIZE];
+} uidl_sbuilder_writer_t;
+
+static void uidl_sbuilder_flush(uidl_sbuilder_writer_t *writer) {
+	if (writer->used == 0) return;
+	writer->chunk[writer->used] = 0;
+	sbuilder_append(writer->sb, writer->chunk);
+	writer->used = 0;
+}
+
+static void uidl_write_sbuilder(void *ctx, const char *data, size_t len) {
+	uidl_sbuilder_writer_t *writer = (uidl_sbuilder_writer_t *)ctx;
+	while (len > 0) {
+		size_t n = sizeof(writer->chunk) - 1 - writer->used;
+		if (n > len) n = len;
+		memcpy(writer->chunk + writer->used, data, n);
+		writer->used += n;
+		data += n;
+		len -= n;
+		if (writer->used == sizeof(writer->chunk) - 1) uidl_sbuilder_flush(writer);
+	}
+}
+
+static void uidl_write_count(void *ctx, const char *data, size_t len) {
+	(void)data;
+	*(size_t *)ctx += len;
+}
+
+typedef struct uidl_buffer_t {
+	char * buf;
+	size_t size;
+	size_t len;
+} uidl_buffer_t;
+
+static void uidl_write_buffer(void *ctx, const char *data, size_t len) {
+	uidl_buffer_t *buffer = (uidl_buffer_t *)ctx;
+	if (buffer->len < buffer->size) {
+		size_t n = buffer->size - buffer->len;
+		memcpy(buffer->buf + buffer->len, data, n < len ? n : len);
+	}
+	buffer->len += len;
+}
+
+typedef struct uidl_chunker_t {
+	uidl_write_t write;
+	void *       ctx;
+	char *       chunk;
+	size_t       chunkSize;
+	size_t       used;
+} uidl_chunker_t;
+
+static void uidl_write_chunked(void *ctx, const char *data, size_t len) {
+	uidl_chunker_t *chunker = (uidl_chunker_t *)ctx;
+	while (len > 0) {
+		size_t n = chunker->chunkSize - chunker->used;
+		if (n > len) n = len;
+		memcpy(chunker->chunk + chunker->used, data, n);
+		chunker->used += n;
+		data += n;
+		len -= n;
+		if (chunker->used == chunker->chunkSize) {
+			chunker->write(chunker->ctx, chunker->chunk, chunker->used);
+			chunker->used = 0;
+		}
+	}
+}
+
+static size_t uidl_buffer_finish(uidl_buffer_t *buffer) {
+	if (buffer->len < buffer->size) buffer->buf[buffer->len] = 0;
+	return buffer->len;
+}
+
+void uidl_to_json(uidl_t *uidl, sbuilder_t *sb) {
+	uidl_sbuilder_writer_t writer;
+	uidl_emitter_t         em = {uidl_write_sbuilder, &writer};
+	writer.sb                 = sb;
+	writer.used               = 0;
+	uidl_emit_uidl(&em, uidl);
+	uidl_sbuilder_flush(&writer);
+}
+size_t uidl_json_size(uidl_t *uidl) {
+	size_t         len = 0;
+	uidl_emitter_t em  = {uidl_write_count, &len};
+	uidl_emit_uidl(&em, uidl);
+	return len;
+}
+size_t uidl_to_json_buffer(uidl_t *uidl, char *buf, size_t size) {
+	uidl_buffer_t  buffer = {buf, size, 0};
+	uidl_emitter_t em     = {uidl_write_buffer, &buffer};
+	uidl_emit_uidl(&em, uidl);
+	return uidl_buffer_finish(&buffer);
+}
+void uidl_to_json_stream(uidl_t *uidl, uidl_write_t write, void *ctx) {
+	uidl_emitter_t em = {write, ctx};
+	uidl_emit_uidl(&em, uidl);
+}
+void uidl_to_json_chunked(
+	uidl_t *uidl, uidl_write_t write, void *ctx, char *chunk, size_t chunkSize) {
+	// an empty chunk would never fill up and flush forever
+	if (!chunk || chunkSize == 0) return;
+	uidl_chunker_t chunker = {write, ctx, chunk, chunkSize, 0};
+	uidl_emitter_t em      = {uidl_write_chunked, &chunker};
+	uidl_emit_uidl(&em, uidl);
+	if (chunker.used > 0) write(ctx, chunk, chunker.used);
+}
+
+void uidl_node_to_json(uidl_node_t *node, sbuilder_t *sb) {
+	uidl_sbuilder_writer_t writer;
+	uidl_emitter_t         em = {uidl_write_sbuilder, &writer};
+	writer.sb                 = sb;
+	writer.used               = 0;
+	uidl_emit_node(&em, node);
+	uidl_sbuilder_flush(&writer);
+}
+size_t uidl_node_json_size(uidl_node_t *node) {
+	size_t         len = 0;
+	uidl_emitter_t em  = {uidl_write_count, &len};
+	uidl_emit_node(&em, node);
+	return len;
+}
+size_t uidl_node_to_json_buffer(uidl_node_t *node, char *buf, size_t size) {
+	uidl_buffer_t  buffer = {buf, size, 0};
+	uidl_emitter_t em     = {uidl_write_buffer, &buffer};
+	uidl_emit_node(&em, node);
+	return uidl_buffer_finish(&buffer);
+}
+void uidl_node_to_json_stream(uidl_node_t *node, uidl_write_t write, void *ctx) {
+	uidl_emitter_t em = {write, ctx};
+	uidl_emit_node(&em, node);
+}
+
+static size_t uidl_format_fixed(char *out, double value, unsigned precision) {
+	static const double scales[] = {
+		1e0, 1e1, 1e2, 1e3, 1e4, 1e5, 1e6, 1e7, 1e8, 1e9};
+	if (precision > 9) precision = 9;
+
+	if (value != value) {
+		memcpy(out, "nan", 3);
+		return 3;
+	}
+	double magnitude = value < 0 ? -value : value;
+	if (!(magnitude * scales[precision] < 1e18)) {
+		return (size_t)snprintf(out, 32, "%.17g", value);
+	}
+
+	// integer arithmetic instead of printf, which is slow (or lacks float
+	// support entirely) on small targets
+	unsigned long long scaled =
+		(unsigned long long)(magnitude * scales[precision] + 0.5);
+	char   digits[24];
+	size_t n   = 0;
+	size_t len = 0;
+	if (value < 0 && scaled > 0) out[len++] = '-';
+	for (unsigned i = 0; i < precision; i++) {
+		digits[n++] = (char)('0' + scaled % 10);
+		scaled /= 10;
+	}
+	if (precision > 0) digits[n++] = '.';
+	do {
+		digits[n++] = (char)('0' + scaled % 10);
+		scaled /= 10;
+	} while (scaled);
+	while (n > 0) out[len++] = digits[--n];
+	return len;
+}
+
+size_t uidl_format_measurement(
+	uidl_t *uidl, char *buf, size_t size, const double *values) {
+	uidl_buffer_t buffer = {buf, size, 0};
+	char          num[32];
+	for (size_t i = 0; i < uidl->nColumns; i++) {
+		if (i > 0) uidl_write_buffer(&buffer, " ", 1);
+		uidl_write_buffer(
+			&buffer,
+			num,
+			uidl_format_fixed(num, values[i], uidl->columns[i].precision));
+	}
+	return uidl_buffer_finish(&buffer);
+}
+
+size_t uidl_format_event(
+	uidl_t *uidl, char *buf, size_t size, const uidl_event_value_t *values) {
+	uidl_buffer_t buffer = {buf, size, 0};
+	char          num[32];
+	for (size_t i = 0; i < uidl->nColumns; i++) {
+		uidl_column_t *col = &uidl->columns[i];
+		if (i > 0) uidl_write_buffer(&buffer, " ", 1);
+		switch (col->type) {
+			case ColumnKey:
+			case ColumnMask:
+				for (unsigned bit = 0; bit < col->count; bit++) {
+					int set = bit < 64 && (values[i].mask >> bit) & 1;
+					uidl_write_buffer(&buffer, set ? "1" : "0", 1);
+				}
+				break;
+			case ColumnStates:
+				if (values[i].state < col->nStates) {
+					const char *state = col->states[values[i].state];
+					uidl_write_buffer(&buffer, state, strlen(state));
+				} else {
+					// keep the field count intact for the parser
+					uidl_write_buffer(&buffer, "?", 1);
+				}
+				break;
+			default:
+				uidl_write_buffer(
+					&buffer, num, uidl_format_fixed(num, values[i].number, col->precision));
+				break;
+		}
+	}
+	return uidl_buffer_finish(&buffer);
+}
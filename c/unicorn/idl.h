@@ -19,9 +19,11 @@ Unicorn. If not, see <https://www.gnu.org/licenses/>.
 #define UNICORN_IDL_H
 
 #include "alpha4c/common/stringbuilder.h"
-typedef struct uidl_t      uidl_t;
-typedef struct uidl_node_t uidl_node_t;
-typedef struct uidl_pair_t uidl_pair_t;
+#include <stddef.h>
+typedef struct uidl_t       uidl_t;
+typedef struct uidl_node_t  uidl_node_t;
+typedef struct uidl_pair_t  uidl_pair_t;
+typedef struct uidl_arena_t uidl_arena_t;
 
 #define UIDL_LIMIT_UPPER 0x01
 #define UIDL_LIMIT_LOWER 0x02
@@ -30,6 +32,18 @@ typedef struct uidl_pair_t uidl_pair_t;
 #define UIDL_COMPL_FLAT 0x01
 #define UIDL_COMPL_ADHOC 0x02
 
+#ifndef UIDL_ARENA_CHUNK_SIZE
+#define UIDL_ARENA_CHUNK_SIZE 1024
+#endif
+
+// Arenas hold whole IDL trees in a few large blocks. While an arena is selected
+// via uidl_arena_use, every uidl_t, node, pair and string created is placed in
+// it and the *_free functions ignore them; uidl_arena_free releases the tree in
+// one call. Pass NULL to uidl_arena_use to return to heap allocation.
+uidl_arena_t *uidl_arena_new(size_t chunkSize);
+void          uidl_arena_free(uidl_arena_t *arena);
+uidl_arena_t *uidl_arena_use(uidl_arena_t *arena);
+
 uidl_t *uidl_new();
 void    uidl_free(uidl_t *uidl);
 
@@ -38,9 +52,54 @@ void uidl_set_completion_metadata(
 	uidl_t *uidl, unsigned flags, const char *chStdout, const char *chStderr);
 void uidl_set_definition(uidl_t *uidl, const char *key, uidl_node_t *node);
 
-void uidl_to_json(uidl_t *node, sbuilder_t *sbuilder);
-
-// todo: implement measurement and events
+// JSON output is produced through a write callback. Besides appending to a
+// string builder, it can be measured exactly (uidl_json_size), written into a
+// caller-provided buffer such as an MQTT publish buffer without any
+// allocation (uidl_to_json_buffer, returning the full length like snprintf
+// and terminating only if there is room) or streamed in fixed-size chunks.
+// uidl_to_json_chunked writes nothing unless chunk is non-NULL and chunkSize
+// is at least 1.
+typedef void (*uidl_write_t)(void *ctx, const char *data, size_t len);
+
+void   uidl_to_json(uidl_t *node, sbuilder_t *sbuilder);
+size_t uidl_json_size(uidl_t *uidl);
+size_t uidl_to_json_buffer(uidl_t *uidl, char *buf, size_t size);
+void   uidl_to_json_stream(uidl_t *uidl, uidl_write_t write, void *ctx);
+void   uidl_to_json_chunked(
+	uidl_t *uidl, uidl_write_t write, void *ctx, char *chunk, size_t chunkSize);
+
+#define UIDL_EVENT_DISREGARD_REPEATED 0x01
+
+// An IDL is either a command (completion), a measurement or an event IDL.
+// Setters for another kind than the IDL already has are ignored;
+// uidl_set_completion releases the node it refuses. Columns without a name
+// are not added.
+// Measurement IDLs describe one column per quantity. Payloads are the values
+// of one reading separated by spaces, each printed with the column's number
+// of fractional digits.
+void uidl_add_measurement(
+	uidl_t *uidl, const char *name, const char *unit, unsigned precision);
+size_t uidl_format_measurement(
+	uidl_t *uidl, char *buf, size_t size, const double *values);
+
+// Event IDLs carry tags and typed columns. Payloads are space separated, one
+// field per column: key and mask columns print their bits as '0'/'1' digits
+// (bit 0 first, count digits), states columns print the state name ('?' for
+// an index past the declared states) and numeric columns the formatted number.
+typedef union uidl_event_value_t {
+	unsigned long long mask;
+	unsigned           state;
+	double             number;
+} uidl_event_value_t;
+
+void uidl_set_event(uidl_t *uidl, const char *tags, unsigned flags);
+void uidl_add_event_key(uidl_t *uidl, const char *name, unsigned count);
+void uidl_add_event_mask(uidl_t *uidl, const char *name, unsigned count);
+void uidl_add_event_states(
+	uidl_t *uidl, const char *name, unsigned nStates, ...);
+void uidl_add_event_numeric(uidl_t *uidl, const char *name, unsigned precision);
+size_t uidl_format_event(
+	uidl_t *uidl, char *buf, size_t size, const uidl_event_value_t *values);
 
 uidl_pair_t *uidl_pair(const char *key, uidl_node_t *node);
 
@@ -53,11 +112,15 @@ uidl_node_t *
 						 uidl_repeat(const char *id, uidl_node_t *subject, unsigned nEndings, ...);
 uidl_node_t *uidl_sequence(const char *id, unsigned count, ...);
 uidl_node_t *uidl_keyword(const char *id, unsigned count, ...);
+uidl_node_t *uidl_keyword_get(uidl_node_t *node, const char *ident);
 void uidl_keyword_set(uidl_node_t *node, const char *ident, uidl_node_t *stmt);
 
 void uidl_node_free(uidl_node_t *node);
 void uidl_pair_free(uidl_pair_t *node);
 
-void uidl_node_to_json(uidl_node_t *node, sbuilder_t *sbuilder);
+void   uidl_node_to_json(uidl_node_t *node, sbuilder_t *sbuilder);
+size_t uidl_node_json_size(uidl_node_t *node);
+size_t uidl_node_to_json_buffer(uidl_node_t *node, char *buf, size_t size);
+void uidl_node_to_json_stream(uidl_node_t *node, uidl_write_t write, void *ctx);
 
 #endif
\ No newline at end of file
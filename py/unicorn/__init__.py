@@ -14,6 +14,15 @@
 # You should have received a copy of the GNU General Public License along with
 # Unicorn. If not, see <https://www.gnu.org/licenses/>.
 
-from . import autocomplete
-from . import idl
-from . import shell
\ No newline at end of file
+import importlib
+
+__all__ = [
+  "autocomplete", "fleet", "idl", "localbroker", "options", "rollup", "shell"
+]
+
+
+# submodules are imported on first access to keep startup cheap
+def __getattr__(name):
+	if name in __all__:
+		return importlib.import_module(f".{name}", __name__)
+	raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
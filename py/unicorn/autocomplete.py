@@ -14,6 +14,7 @@
 # You should have received a copy of the GNU General Public License along with
 # Unicorn. If not, see <https://www.gnu.org/licenses/>.
 
+import io
 import shlex
 import json
 from collections import namedtuple
@@ -26,17 +27,30 @@ class TokenStream:
 	def __init__(s, code, loc):
 		strings = shlex.split(code[:loc])
 		if len(strings) < 1:
-			s._tokens = [token_t("", 0)]
+			prefix = strings
+			suffix = ""
+		elif code[-1] in {" ", "\t"}:
+			prefix = strings
+			suffix = ""
 		else:
-			if code[-1] in {" ", "\t"}:
-				prefix = strings
-				suffix = ""
-			else:
-				prefix = strings[:-1]
-				suffix = strings[-1]
-			s._tokens = [token_t(v, None) for v in prefix]
-			s._tokens.append(token_t(suffix, len(suffix)))
+			prefix = strings[:-1]
+			suffix = strings[-1]
+		s._init(prefix, suffix)
+
+	def _init(s, prefix, suffix):
+		s._tokens = [token_t(v, None) for v in prefix]
+		s._tokens.append(token_t(suffix, len(suffix)))
 		s._index = 0
+		# literals compared against the cursor token by more than a prefix match,
+		# and whether completion options were computed dynamically
+		s.literals = set()
+		s.volatile = False
+
+	@classmethod
+	def FromStrings(cls, prefix, suffix):
+		res = cls.__new__(cls)
+		res._init(prefix, suffix)
+		return res
 
 	def next(s, peek=False):
 		if s._index >= len(s._tokens):
@@ -55,6 +69,89 @@ class TokenStream:
 		return s._index >= len(s._tokens)
 
 
+class Completer:
+	def __init__(s, root):
+		s._root = root
+		s._head = None
+		s._strings = None
+		s._candidates = None
+		s._error = None
+		s._literals = None
+		s._volatile = False
+
+	@property
+	def root(s):
+		return s._root
+
+	def _split(s, code):
+		if s._head is not None and code.startswith(s._head):
+			head = s._head
+			strings = list(s._strings)
+		else:
+			head = ""
+			strings = list()
+		rest = code[len(head):]
+
+		scanner = shlex.shlex(rest, posix=True)
+		scanner.whitespace_split = True
+		scanner.commenters = ""
+		starts = list()
+		toks = list()
+		while True:
+			pos = scanner.instream.tell()
+			tok = scanner.get_token()
+			if tok is None: break
+			starts.append(pos)
+			toks.append(tok)
+
+		if len(toks) < 1 or rest[-1] in {" ", "\t"}:
+			return code, strings + toks, ""
+		return head + rest[:starts[-1]], strings + toks[:-1], toks[-1]
+
+	def _walk(s, toks):
+		try:
+			return list(s._root.complete(toks)), None
+		except SyntaxError as e:
+			return None, e
+
+	def complete(s, code, loc=None):
+		if loc is not None:
+			code = code[:loc]
+		head, strings, suffix = s._split(code)
+
+		if head != s._head:
+			# walk the grammar once for the new prefix with an empty cursor token,
+			# every further keystroke in the last token only filters the result
+			toks = TokenStream.FromStrings(strings, "")
+			s._candidates, s._error = s._walk(toks)
+			s._head = head
+			s._strings = strings
+			s._literals = toks.literals
+			s._volatile = toks.volatile
+
+		if s._volatile or suffix in s._literals:
+			candidates, error = s._walk(TokenStream.FromStrings(strings, suffix))
+		else:
+			candidates, error = s._candidates, s._error
+			if candidates is not None and len(suffix) > 0:
+				prefix = suffix.lower()
+				candidates = [v for v in candidates if v.lower().startswith(prefix)]
+
+		if error is not None:
+			raise error
+		return candidates
+
+	def check(s, code):
+		# walk the grammar over a finished command line, raising SyntaxError if it
+		# is rejected or leaves arguments unconsumed
+		toks = TokenStream.FromStrings(shlex.split(code), "")
+		_, error = s._walk(toks)
+		if error is not None:
+			raise error
+		if toks.remaining > 1:
+			raise SyntaxError("unexpected argument %s" % toks.next().code)
+
+
 class Node:
 	def __init__(s, id=None):
 		s._id = id
@@ -66,16 +163,138 @@ class Node:
 	def complete(s, toks):
 		raise NotImplementedError()
 
-	def toDict(s):
+	def children(s):
+		return ()
+
+	def _fields(s):
 		raise NotImplementedError()
 
+	def toDict(s):
+		return Serializer(s).toDict()
+
 	def toJSON(s):
-		return json.dumps(s.toDict())
+		f = io.StringIO()
+		s.dump(f)
+		return f.getvalue()
+
+	def dump(s, f):
+		Serializer(s).dump(f)
 
 	def traverse(s, followReferences=False):
 		yield s
 
 
+class Serializer:
+	def __init__(s, root):
+		s._root = root
+		s._names = dict()
+		s._scan()
+
+	def _scan(s):
+		# composite nodes reachable more than once (shared or cyclic) are written
+		# once and referenced afterwards, anonymous ones get a generated id
+		ids = set()
+		seen = set()
+		shared = list()
+		stack = [s._root]
+		while len(stack) > 0:
+			node = stack.pop()
+			if node in seen:
+				if node not in s._names and len(node.children()) > 0:
+					s._names[node] = None
+					shared.append(node)
+				continue
+			seen.add(node)
+			if node.id is not None:
+				ids.add(node.id)
+			stack.extend(node.children())
+
+		counter = 0
+		for node in shared:
+			if node.id is not None:
+				s._names[node] = node.id
+				continue
+			while f"_ref{counter}" in ids:
+				counter += 1
+			s._names[node] = f"_ref{counter}"
+			ids.add(s._names[node])
+
+	def _nodeFields(s, node):
+		fields = node._fields()
+		if fields is None or node not in s._names:
+			return fields
+		return [(k, v) for k, v in fields if k != "id"] + [("id", s._names[node])]
+
+	def toDict(s):
+		written = set()
+
+		def node_dict(node):
+			if node in written:
+				return {"type": "reference", "ref": s._names[node]}
+			if node in s._names:
+				written.add(node)
+			fields = s._nodeFields(node)
+			if fields is None: return None
+			return {k: value(v) for k, v in fields}
+
+		def value(v):
+			if isinstance(v, Node):
+				return node_dict(v)
+			elif isinstance(v, dict):
+				return {k: value(e) for k, e in v.items()}
+			elif isinstance(v, (list, tuple)):
+				return [value(e) for e in v]
+			return v
+
+		return node_dict(s._root)
+
+	def dump(s, f):
+		written = set()
+		write = f.write
+
+		def node_json(node):
+			if node in written:
+				write('{"type": "reference", "ref": ')
+				write(json.dumps(s._names[node]))
+				write("}")
+				return
+			if node in s._names:
+				written.add(node)
+			fields = s._nodeFields(node)
+			if fields is None:
+				write("null")
+				return
+			write("{")
+			for i, (k, v) in enumerate(fields):
+				if i > 0: write(", ")
+				write(json.dumps(k))
+				write(": ")
+				value(v)
+			write("}")
+
+		def value(v):
+			if isinstance(v, Node):
+				node_json(v)
+			elif isinstance(v, dict):
+				write("{")
+				for i, (k, e) in enumerate(v.items()):
+					if i > 0: write(", ")
+					write(json.dumps(k))
+					write(": ")
+					value(e)
+				write("}")
+			elif isinstance(v, (list, tuple)):
+				write("[")
+				for i, e in enumerate(v):
+					if i > 0: write(", ")
+					value(e)
+				write("]")
+			else:
+				write(json.dumps(v))
+
+		node_json(s._root)
+
+
 class Reference(Node):
 	def __init__(s, ref):
 		Node.__init__(s)
@@ -93,11 +312,8 @@ class Reference(Node):
 		if s.node is not None:
 			yield from s.node.complete(toks)
 
-	def toDict(s):
-		options = None
-		if type(s._options) == set:
-			options = list(sorted(s._options))
-		return {"type": "string", "id": s._id, "options": options}
+	def _fields(s):
+		return [("type", "reference"), ("ref", s._ref)]
 
 	@classmethod
 	def FromJSON(s, obj):
@@ -129,15 +345,12 @@ class Keyword(Node):
 				if kw.lower().startswith(prefix):
 					yield kw
 
-	def toDict(s):
-		if hasattr(s, "_outputting"): return "null"
-		setattr(s, "_outputting", True)
-		res = {
-		  "type": "keyword", "stmts": {k: v.toDict()
-		                               for k, v in s._stmts.items()}
-		}
-		if s.id is not None: res["id"] = s.id
-		delattr(s, "_outputting")
+	def children(s):
+		return tuple(s._stmts.values())
+
+	def _fields(s):
+		res = [("type", "keyword"), ("stmts", s._stmts)]
+		if s.id is not None: res.append(("id", s.id))
 		return res
 
 	@classmethod
@@ -164,12 +377,12 @@ class Sequence(Node):
 			done = toks.eof
 			if done: break
 
-	def toDict(s):
-		if hasattr(s, "_outputting"): return "null"
-		setattr(s, "_outputting", True)
-		res = {"type": "sequence", "stmts": list([v.toDict() for v in s._stmts])}
-		delattr(s, "_outputting")
-		if s.id is not None: res["id"] = s.id
+	def children(s):
+		return tuple(s._stmts)
+
+	def _fields(s):
+		res = [("type", "sequence"), ("stmts", s._stmts)]
+		if s.id is not None: res.append(("id", s.id))
 		return res
 
 	@classmethod
@@ -201,6 +414,7 @@ class String(Node):
 		if type(s._options) == set:
 			opts = s._options
 		elif callable(s._options):
+			toks.volatile = True
 			opts = s._options(toks)
 
 		prefix = tok.code[:tok.cursor].lower()
@@ -208,11 +422,11 @@ class String(Node):
 			if opt.lower().startswith(prefix):
 				yield opt
 
-	def toDict(s):
+	def _fields(s):
 		options = None
 		if type(s._options) == set:
 			options = list(sorted(s._options))
-		return {"type": "string", "id": s.id, "options": options}
+		return [("type", "string"), ("id", s.id), ("options", options)]
 
 	@classmethod
 	def FromJSON(s, obj):
@@ -239,22 +453,9 @@ class Number(Node):
 				setattr(toks, s._id, tok.code)
 			return
 
-		opts = set()
-		if type(s._options) == set:
-			opts = s._options
-		elif callable(s._options):
-			opts = s._options(toks)
-
-		prefix = tok.code[:tok.cursor].lower()
-		for opt in opts:
-			if opt.lower().startswith(prefix):
-				yield opt
-
-	def toDict(s):
-		return {
-		  "type": "number", "id": s.id, "integer": s._integer, "min": s._min,
-		  "max": s._max
-		}
+	def _fields(s):
+		return [("type", "number"), ("id", s.id), ("integer", s._integer),
+		        ("min", s._min), ("max", s._max)]
 
 	@classmethod
 	def FromJSON(s, obj):
@@ -285,6 +486,7 @@ class Repeat(Node):
 			if s._end is not None:
 				tok = toks.next(peek=True)
 				if tok.cursor is not None:
+					toks.literals.update(s._end_set)
 					prefix = tok.code[:tok.cursor].lower()
 					for lit in sorted(s._end_set):
 						if lit.lower().startswith(prefix):
@@ -296,16 +498,13 @@ class Repeat(Node):
 			done = toks.eof
 			if done: break
 
-	def toDict(s):
-		if hasattr(s, "_outputting"): return "null"
-		setattr(s, "_outputting", True)
-		res = {
-		  "type": "repeat", "stmt": s._stmt.toDict(), "end": s._end,
-		  "peekEnd": s._peekEnd
-		}
-		if s.id is not None: res["id"] = s.id
-
-		delattr(s, "_outputting")
+	def children(s):
+		return (s._stmt, )
+
+	def _fields(s):
+		res = [("type", "repeat"), ("stmt", s._stmt), ("end", s._end),
+		       ("peekEnd", s._peekEnd)]
+		if s.id is not None: res.append(("id", s.id))
 		return res
 
 	@classmethod
@@ -329,7 +528,7 @@ class Empty(Node):
 		if False: yield None
 		pass
 
-	def toDict(s):
+	def _fields(s):
 		return None
 
 	@classmethod
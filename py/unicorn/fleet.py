@@ -0,0 +1,590 @@
+# Copyright 2022 Peter Wagener <mail@peterwagener.net>
+#
+# This file is part of the Unicorn framework.
+#
+# Unicorn is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Unicorn is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Unicorn. If not, see <https://www.gnu.org/licenses/>.
+
+
+# Load test harness: spawns a fleet of simulated devices from IDL templates
+# against the local broker stand-in (or a real broker) and measures how the
+# shell copes as the fleet grows. Each step runs a probe in a fresh shell
+# process that reports IDL convergence time, single command latency and the
+# time of one fan-out command to the whole fleet.
+
+import os
+import sys
+import json
+import time
+import shlex
+import random
+import struct
+import asyncio
+import threading
+from . import localbroker
+from .localbroker import packet, encode_string, decode_string, read_packet
+
+# topic suffix -> IDL, "{device}" in any string is replaced by the device name
+default_templates = {
+  "cmd": {
+    "completion": {
+      "type": "keyword",
+      "stmts": {
+        "ping": None,
+        "echo": {
+          "type": "repeat",
+          "stmt": {
+            "type": "string",
+            "options": None
+          }
+        },
+        "fail": None,
+        "sleep": {
+          "type": "number",
+          "min": 0,
+          "max": 10
+        },
+      }
+    },
+    "stdout": "{device}/cmd/out",
+    "stderr": "{device}/cmd/err",
+    "result": "{device}/cmd/ret",
+    "adHocChannels": True,
+  },
+  "env": {
+    "measurement": [{
+      "name": "temperature",
+      "unit": "K"
+    }, {
+      "name": "humidity",
+      "unit": "1"
+    }]
+  },
+  "button": {
+    "event": {
+      "tags": "button",
+      "columns": [{
+        "name": "keys",
+        "type": "key",
+        "count": 4
+      }]
+    }
+  },
+}
+
+
+def instantiate(template, device):
+	if isinstance(template, str):
+		return template.replace("{device}", device)
+	if isinstance(template, dict):
+		return {k: instantiate(v, device) for k, v in template.items()}
+	if isinstance(template, list):
+		return [instantiate(v, device) for v in template]
+	return template
+
+
+class AsyncClient:
+	# just enough of an MQTT client for simulated devices, one asyncio
+	# connection each instead of a paho thread per device
+	def __init__(s, on_message=None):
+		s.on_message = on_message
+		s.reader = None
+		s.writer = None
+		s.mid = 0
+		s.task = None
+
+	async def connect(s, host, port, client_id, will=None):
+		s.reader, s.writer = await asyncio.open_connection(host, port)
+		flags = 0x02
+		payload = encode_string(client_id)
+		if will is not None:
+			topic, message, retain = will
+			flags |= 0x04 | (0x20 if retain else 0)
+			payload += encode_string(topic) + encode_string(message)
+		s.writer.write(
+		  packet(localbroker.CONNECT,
+		         encode_string("MQTT") + bytes([4, flags]) + struct.pack(">H", 0) +
+		         payload))
+		header, body = await read_packet(s.reader)
+		if header >> 4 != localbroker.CONNACK or body[1] != 0:
+			raise ConnectionError(f"connection refused by {host}:{port}")
+		s.task = asyncio.ensure_future(s.receive())
+
+	async def receive(s):
+		try:
+			while True:
+				header, body = await read_packet(s.reader)
+				if header >> 4 != localbroker.PUBLISH: continue
+				topic, pos = decode_string(body, 0)
+				if (header >> 1) & 3: pos += 2
+				if s.on_message is not None:
+					s.on_message(topic.decode(), body[pos:])
+		except (asyncio.IncompleteReadError, ConnectionError) as e:
+			pass
+
+	def subscribe(s, filters):
+		s.mid = s.mid % 65535 + 1
+		s.writer.write(
+		  packet(localbroker.SUBSCRIBE,
+		         struct.pack(">H", s.mid) +
+		         b"".join(encode_string(flt) + b"\x00" for flt in filters), 2))
+
+	def publish(s, topic, payload, retain=False):
+		s.writer.write(localbroker.publish_packet(topic, payload, retain))
+
+	async def disconnect(s):
+		s.writer.write(packet(localbroker.DISCONNECT))
+		await s.writer.drain()
+		s.writer.close()
+		if s.task is not None:
+			s.task.cancel()
+
+
+class SimDevice:
+	def __init__(s, fleet, name):
+		s.fleet = fleet
+		s.name = name
+		s.idls = {
+		  f"{name}/{suffix}": instantiate(template, name)
+		  for suffix, template in fleet.templates.items()
+		}
+		s.outputs = {
+		  data[kind]
+		  for data in s.idls.values() for kind in ("stdout", "stderr", "result")
+		  if data.get(kind, None) is not None
+		}
+		s.client = AsyncClient(on_message=s.on_message)
+		s.tasks = list()
+
+	async def start(s):
+		# announcements go to /unicorn, the will announces an unexpected departure
+		await s.client.connect(
+		  s.fleet.host, s.fleet.port, s.name,
+		  ("/unicorn", json.dumps({"device": s.name, "state": "disconnected"}),
+		   False))
+		filters = list()
+		for topic, data in s.idls.items():
+			if not "completion" in data: continue
+			filters.append(topic)
+			if data.get("adHocChannels", False):
+				filters.append(topic + "/+")
+		if len(filters) > 0:
+			s.client.subscribe(filters)
+
+		s.client.publish("/unicorn",
+		                 json.dumps({
+		                   "device": s.name,
+		                   "state": "connected"
+		                 }))
+		for topic, data in s.idls.items():
+			s.client.publish("/unicorn/idl/" + topic, json.dumps(data), retain=True)
+		# standing in for the services manager
+		s.client.publish("/unicorn/active/" + s.name, "1", retain=True)
+
+		for topic, data in s.idls.items():
+			if "measurement" in data and s.fleet.measurement_rate > 0:
+				s.tasks.append(
+				  asyncio.ensure_future(
+				    s.emit(topic, s.fleet.measurement_rate, s.measurement)))
+			elif "event" in data and s.fleet.event_rate > 0:
+				s.tasks.append(
+				  asyncio.ensure_future(s.emit(topic, s.fleet.event_rate, s.event)))
+
+	async def stop(s):
+		for task in s.tasks:
+			task.cancel()
+		for topic in s.idls:
+			s.client.publish("/unicorn/idl/" + topic, b"", retain=True)
+		s.client.publish("/unicorn/active/" + s.name, b"", retain=True)
+		s.client.publish("/unicorn",
+		                 json.dumps({
+		                   "device": s.name,
+		                   "state": "disconnected"
+		                 }))
+		await s.client.disconnect()
+
+	async def emit(s, topic, rate, sample):
+		# random phase, so the fleet does not publish in lockstep
+		await asyncio.sleep(random.uniform(0, 1 / rate))
+		state = dict()
+		while True:
+			s.client.publish(topic, sample(s.idls[topic], state))
+			await asyncio.sleep(1 / rate)
+
+	def measurement(s, data, state):
+		items = data["measurement"]
+		if isinstance(items, dict):
+			items = [items]
+		values = state.setdefault("values", [random.uniform(0, 100) for _ in items])
+		for i in range(len(values)):
+			values[i] += random.gauss(0, 0.1)
+		return " ".join(f"{v:.3f}" for v in values)
+
+	def event(s, data, state):
+		columns = data["event"].get("columns", [])
+		if isinstance(columns, dict):
+			columns = [columns]
+		fields = list()
+		for column in columns:
+			if "states" in column:
+				fields.append(random.choice(column["states"]))
+			elif "count" in column:
+				fields.append("".join(random.choice("01") for _ in range(column["count"])))
+			else:
+				fields.append(f"{random.uniform(0, 1):.3f}")
+		return " ".join(fields)
+
+	def on_message(s, topic, payload):
+		# output channels may sit below the command topic and come back to us
+		if topic in s.outputs: return
+		base, _, channel = topic.rpartition("/")
+		if base in s.idls and topic not in s.idls:
+			data = s.idls[base]
+			suffix = "/" + channel
+		elif topic in s.idls:
+			data = s.idls[topic]
+			suffix = ""
+		else:
+			return
+		asyncio.ensure_future(s.respond(data, suffix, payload.decode(errors="replace")))
+
+	async def respond(s, data, suffix, cmdline):
+		def reply(kind, text):
+			if data.get(kind, None) is not None:
+				s.client.publish(data[kind] + suffix, text)
+
+		try:
+			args = shlex.split(cmdline)
+		except ValueError as e:
+			args = ["?"]
+		if len(args) < 1 or args[0] == "ping":
+			reply("stdout", "pong")
+			reply("result", "0")
+		elif args[0] == "echo":
+			reply("stdout", " ".join(args[1:]))
+			reply("result", "0")
+		elif args[0] == "sleep" and len(args) > 1:
+			try:
+				await asyncio.sleep(float(args[1]))
+			except ValueError:
+				pass
+			reply("result", "0")
+		elif args[0] == "fail":
+			reply("stderr", "failed on request")
+			reply("result", "1")
+		else:
+			reply("stderr", f"unknown command: {args[0]}")
+			reply("result", "127")
+
+
+class Fleet:
+	def __init__(s,
+	             host,
+	             port,
+	             templates=None,
+	             measurement_rate=0.0,
+	             event_rate=0.0,
+	             prefix="sim"):
+		s.host = host
+		s.port = port
+		s.templates = default_templates if templates is None else templates
+		s.measurement_rate = measurement_rate
+		s.event_rate = event_rate
+		s.prefix = prefix
+		s.devices = list()
+
+	@property
+	def command_topics(s):
+		return [
+		  f"{device.name}/{suffix}" for device in s.devices
+		  for suffix, template in s.templates.items() if "completion" in template
+		]
+
+	async def grow(s, count):
+		new = [
+		  SimDevice(s, f"{s.prefix}{i:05d}") for i in range(len(s.devices), count)
+		]
+		await asyncio.gather(*[device.start() for device in new])
+		s.devices += new
+
+	async def stop(s):
+		await asyncio.gather(*[device.stop() for device in s.devices])
+		s.devices = list()
+
+
+def percentile(values, p):
+	if len(values) < 1: return float("nan")
+	values = sorted(values)
+	return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+class ProbeRenderer:
+	# stands in for the shell's renderer: counts result lines instead of
+	# drawing them, so the probe can tell when a command was answered
+	def __init__(s):
+		s.cond = threading.Condition()
+		s.results = 0
+
+	def push(s, ln):
+		if not ln.startswith("[\x1b[35;1mret"): return
+		with s.cond:
+			s.results += 1
+			s.cond.notify_all()
+
+	def flush(s):
+		pass
+
+	def wait(s, count, timeout):
+		deadline = time.monotonic() + timeout
+		with s.cond:
+			while s.results < count:
+				remaining = deadline - time.monotonic()
+				if remaining <= 0: return False
+				s.cond.wait(remaining)
+		return True
+
+
+def probe(host, port, expect, commands, timeout):
+	# runs in a fresh process, so every step measures a cold shell
+	from . import shell
+	shell.configure(host, port, None, None)
+	res = {"expect": expect}
+
+	t0 = time.monotonic()
+	deadline = t0 + timeout
+	shell.start_brokers(timeout=timeout)
+	while len(shell.topic_idl_map) < expect:
+		with shell.ev_mutex:
+			while shell.ev_peek() is None:
+				remaining = deadline - time.monotonic()
+				if remaining <= 0: break
+				shell.ev_cond.wait(remaining)
+			ev = shell.ev_pop() if shell.ev_peek() is not None else None
+		if ev is None: break
+		if ev.kind == shell.EV_IDL_CONFIG:
+			shell.apply_idl(*ev.payload)
+	res["idls"] = len(shell.topic_idl_map)
+	res["convergence"] = time.monotonic() - t0
+	shell.build_lang(write_cache=False)
+
+	# single commands take the interactive path: decode, subscribe the
+	# response channels, publish and wait for the result to be printed
+	renderer = shell.renderer = ProbeRenderer()
+	client = shell.broker_for(None).client
+	keys = sorted(shell.topic_idl_map)
+	latencies = list()
+	failures = 0
+	for i in range(commands if len(keys) > 0 else 0):
+		cmdline = " ".join(random.choice(keys).split("/")) + " ping"
+		expected = renderer.results + 1
+		t = time.monotonic()
+		shell.process_command(client, cmdline)
+		if renderer.wait(expected, shell.command_timeout):
+			latencies.append(time.monotonic() - t)
+		else:
+			failures += 1
+	res["command_p50"] = percentile(latencies, 50)
+	res["command_p95"] = percentile(latencies, 95)
+	res["command_failures"] = failures
+
+	t = time.monotonic()
+	targets = shell.process_fanout("@# ping", lambda ln: None) or list()
+	res["fanout"] = time.monotonic() - t
+	res["fanout_ok"] = sum(1 for target in targets if target.status == "ok")
+
+	if shell.idl_parser is not None:
+		shell.idl_parser.close()
+	return res
+
+
+async def run_probe(host, port, expect, commands, timeout):
+	env = dict(os.environ)
+	root = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+	env["PYTHONPATH"] = os.pathsep.join(
+	  v for v in (root, env.get("PYTHONPATH", None)) if v)
+	proc = await asyncio.create_subprocess_exec(sys.executable,
+	                                            "-m",
+	                                            "unicorn.fleet",
+	                                            "--probe",
+	                                            f"--broker={host}:{port}",
+	                                            f"--expect={expect}",
+	                                            f"--commands={commands}",
+	                                            f"--timeout={timeout}",
+	                                            stdout=asyncio.subprocess.PIPE,
+	                                            env=env)
+	out, _ = await proc.communicate()
+	try:
+		return json.loads(out.decode().strip().splitlines()[-1])
+	except (IndexError, ValueError) as e:
+		return None
+
+
+def print_report_header(f):
+	f.write(f"{'devices':>8} {'idls':>6} {'converge':>9} {'cmd p50':>9} "
+	        f"{'cmd p95':>9} {'cmd fail':>8} {'fan-out':>9} {'fan-out ok':>10}\n")
+	f.flush()
+
+
+def print_report_row(f, devices, res):
+	if res is None:
+		f.write(f"{devices:>8} probe failed\n")
+	else:
+		f.write(f"{devices:>8} {res['idls']:>6} {res['convergence']:>8.3f}s "
+		        f"{res['command_p50'] * 1000:>7.1f}ms "
+		        f"{res['command_p95'] * 1000:>7.1f}ms {res['command_failures']:>8} "
+		        f"{res['fanout']:>8.3f}s "
+		        f"{res['fanout_ok']:>10}\n")
+	f.flush()
+
+
+async def bench(host,
+                port,
+                counts,
+                templates=None,
+                measurement_rate=0.0,
+                event_rate=0.0,
+                commands=20,
+                timeout=60.0,
+                serve=False):
+	broker = None
+	if host is None:
+		broker = localbroker.LocalBroker()
+		host = "127.0.0.1"
+		port = await broker.start(host, port or 0)
+		sys.stderr.write(f"local broker listening on {host}:{port}\n")
+
+	fleet = Fleet(host,
+	              port,
+	              templates=templates,
+	              measurement_rate=measurement_rate,
+	              event_rate=event_rate)
+	try:
+		if serve:
+			await fleet.grow(max(counts))
+			sys.stderr.write(f"{len(fleet.devices)} devices running\n")
+			await asyncio.Event().wait()
+
+		print_report_header(sys.stdout)
+		for count in counts:
+			await fleet.grow(count)
+			res = await run_probe(host, port, len(fleet.command_topics), commands,
+			                      timeout)
+			print_report_row(sys.stdout, count, res)
+	finally:
+		await fleet.stop()
+		if broker is not None:
+			broker.close()
+
+
+def print_help(f):
+	f.write("unicorn-fleet [options]\n"
+	        "options:\n"
+	        "  -h|--help\n"
+	        "    print this help text and exit normally\n"
+	        "  --devices=<n>[,<n>...]\n"
+	        "    fleet sizes to step through, default 10,100\n"
+	        "  --broker=<host>[:<port>]\n"
+	        "    use this broker instead of the built-in stand-in\n"
+	        "  --port=<port>\n"
+	        "    port of the built-in broker, default any free port\n"
+	        "  --templates=<file>\n"
+	        "    JSON object mapping topic suffixes to IDLs, {device} is replaced\n"
+	        "  --measurement-rate=<hz>\n"
+	        "    samples per second on every measurement topic, default 0\n"
+	        "  --event-rate=<hz>\n"
+	        "    events per second on every event topic, default 0\n"
+	        "  --commands=<n>\n"
+	        "    single commands timed per step, default 20\n"
+	        "  --timeout=<seconds>\n"
+	        "    give up on convergence after this long, default 60\n"
+	        "  --serve\n"
+	        "    run the largest fleet until interrupted instead of measuring\n")
+	f.flush()
+
+
+def main(argv=None):
+	if argv is None:
+		argv = sys.argv[1:]
+
+	host = None
+	port = None
+	counts = [10, 100]
+	templates = None
+	measurement_rate = 0.0
+	event_rate = 0.0
+	commands = 20
+	timeout = 60.0
+	expect = 0
+	fProbe = False
+	fServe = False
+	for arg in argv:
+		try:
+			if arg in {"-h", "--help"}:
+				print_help(sys.stdout)
+				return 0
+			elif arg.startswith("--devices="):
+				counts = sorted(int(v) for v in arg[10:].split(","))
+			elif arg.startswith("--broker="):
+				host, sep, p = arg[9:].rpartition(":")
+				if sep and p.isdigit():
+					port = int(p)
+				else:
+					host = arg[9:]
+					port = 1883
+			elif arg.startswith("--port="):
+				port = int(arg[7:])
+			elif arg.startswith("--templates="):
+				with open(arg[12:], "r") as f:
+					templates = json.load(f)
+			elif arg.startswith("--measurement-rate="):
+				measurement_rate = float(arg[19:])
+			elif arg.startswith("--event-rate="):
+				event_rate = float(arg[13:])
+			elif arg.startswith("--commands="):
+				commands = int(arg[11:])
+			elif arg.startswith("--timeout="):
+				timeout = float(arg[10:])
+			elif arg.startswith("--expect="):
+				expect = int(arg[9:])
+			elif arg == "--probe":
+				fProbe = True
+			elif arg == "--serve":
+				fServe = True
+			else:
+				raise ValueError(arg)
+		except (ValueError, OSError) as e:
+			print_help(sys.stderr)
+			sys.stderr.write("\x1b[31;1mError\x1b[30;0m: invalid argument %s\n" % arg)
+			return 1
+
+	if fProbe:
+		print(json.dumps(probe(host, port, expect, commands, timeout)))
+		return 0
+
+	try:
+		asyncio.run(
+		  bench(host,
+		        port,
+		        counts,
+		        templates=templates,
+		        measurement_rate=measurement_rate,
+		        event_rate=event_rate,
+		        commands=commands,
+		        timeout=timeout,
+		        serve=fServe))
+	except KeyboardInterrupt:
+		pass
+	return 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -14,18 +14,20 @@
 # You should have received a copy of the GNU General Public License along with
 # Unicorn. If not, see <https://www.gnu.org/licenses/>.
 
+import io
 import json
 from . import autocomplete
 
 import os
+import threading
+import importlib.util
+from collections import deque
 
-try:
-	import jsonschema
-	has_jsonschema = True
-except ModuleNotFoundError:
-	has_jsonschema = False
+# jsonschema is slow to import and only needed when validating
+has_jsonschema = importlib.util.find_spec("jsonschema") is not None
 
 schema = None
+validator = None
 
 
 def getSchema():
@@ -38,6 +40,16 @@ def getSchema():
 	return schema
 
 
+def getValidator():
+	# building a validator checks the schema itself, do that once per process
+	global validator
+	if validator is None:
+		import jsonschema
+		cls = jsonschema.validators.validator_for(getSchema())
+		validator = cls(getSchema())
+	return validator
+
+
 class IDL:
 	def __init__(s,
 	             topic,
@@ -56,6 +68,7 @@ class IDL:
 		s._result = result
 		s._adHocChannels = adHocChannels
 		s._logging = logging
+		s._json = None
 
 	@property
 	def topic(s):
@@ -85,23 +98,192 @@ class IDL:
 	def adHocChannels(s):
 		return s._adHocChannels
 
-	def toDict(s):
-		res = {"completion": s._completion.toDict()}
-		for k in ("flat", "stdout", "stderr", "logging"):
+	def _fields(s):
+		for k in ("flat", "stdout", "stderr", "result", "adHocChannels",
+		          "logging"):
 			v = getattr(s, f"_{k}")
 			if v is not None:
-				res[k] = v
+				yield k, v
 
+	def toDict(s):
+		res = {"completion": s._completion.toDict()}
+		res.update(s._fields())
 		return res
 
+	def dump(s, f):
+		if s._json is not None:
+			f.write(s._json)
+			return
+		f.write('{"completion": ')
+		s._completion.dump(f)
+		for k, v in s._fields():
+			f.write(f", {json.dumps(k)}: {json.dumps(v)}")
+		f.write("}")
+
 	def toJSON(s):
-		return json.dumps(s.toDict())
+		# IDLs are immutable, so the serialized form is computed at most once
+		if s._json is None:
+			f = io.StringIO()
+			s.dump(f)
+			s._json = f.getvalue()
+		return s._json
 
 	@classmethod
-	def FromJSON(cls, topic, obj, validate=True):
+	def FromJSON(cls, topic, obj, validate=True, raw=None):
 		args = dict(obj)
 		if has_jsonschema and validate:
-			jsonschema.validate(args, getSchema())
+			import jsonschema
+			error = jsonschema.exceptions.best_match(getValidator().iter_errors(args))
+			if error is not None:
+				raise error
 		args["completion"] = autocomplete.NodeFromJSON(args["completion"])
 		autocomplete.ResolveReferences(args["completion"])
-		return IDL(topic, **args)
+		res = IDL(topic, **args)
+		res._json = raw
+		return res
+
+
+class Measurement:
+	def __init__(s, topic, columns, logging=None):
+		s._topic = topic
+		s._columns = list(columns)
+		s._logging = logging
+
+	@property
+	def topic(s):
+		return s._topic
+
+	@property
+	def columns(s):
+		# list of (name, unit), name is None for a single unnamed quantity
+		return s._columns
+
+	def toDict(s):
+		items = list()
+		for name, unit in s._columns:
+			item = {"name": name, "unit": unit}
+			if name is None: del item["name"]
+			items.append(item)
+		res = {"measurement": items}
+		if s._logging is not None:
+			res["logging"] = s._logging
+		return res
+
+	def toJSON(s):
+		return json.dumps(s.toDict())
+
+	@classmethod
+	def FromJSON(cls, topic, obj, validate=True):
+		if has_jsonschema and validate:
+			import jsonschema
+			error = jsonschema.exceptions.best_match(getValidator().iter_errors(obj))
+			if error is not None:
+				raise error
+		items = obj["measurement"]
+		if isinstance(items, dict):
+			items = [items]
+		return Measurement(topic, [(item.get("name", None), item["unit"])
+		                           for item in items],
+		                   logging=obj.get("logging", None))
+
+
+def parseIDL(topic, raw, validate=True):
+	# decodes and validates an IDL payload, returning the IDL (or None if the
+	# payload is not a command IDL) and an error message. runs on pool workers
+	try:
+		data = json.loads(raw)
+	except json.JSONDecodeError as e:
+		return None, None
+	if not isinstance(data, dict) or not "completion" in data:
+		return None, None
+	if has_jsonschema and validate:
+		import jsonschema
+		invalid = jsonschema.exceptions.ValidationError
+	else:
+		invalid = ()
+	try:
+		return IDL.FromJSON(topic, data, validate=validate, raw=raw), None
+	except invalid as e:
+		return None, "\n".join((f"invalid IDL for topic {topic}",
+		                        json.dumps(data, indent='  '), str(e)))
+	except Exception as e:
+		import traceback
+		return None, f"{topic}\n{traceback.format_exc()}"
+
+
+class ParserPool:
+	# parses IDL payloads on worker processes, handing the results to callback
+	# (topic, idl, error, tag) in submission order per topic. with zero workers
+	# payloads are parsed right away on the submitting thread
+	def __init__(s, callback, workers=None):
+		s._callback = callback
+		s._workers = workers
+		s._executor = None
+		s._queues = dict()
+		s._futures = set()
+		s._pending = 0
+		s._closed = False
+		s._mutex = threading.RLock()
+
+	@property
+	def pending(s):
+		return s._pending
+
+	def _start(s):
+		import multiprocessing
+		import concurrent.futures
+		# spawn, not fork: the shell runs network and terminal threads whose
+		# locks must not end up copied into the workers
+		s._executor = concurrent.futures.ProcessPoolExecutor(
+		  max_workers=s._workers, mp_context=multiprocessing.get_context("spawn"))
+
+	def submit(s, topic, raw, validate=True, tag=None):
+		if s._workers == 0:
+			s._callback(topic, *parseIDL(topic, raw, validate), tag)
+			return
+
+		entry = [tag, None]
+		with s._mutex:
+			s._queues.setdefault(topic, deque()).append(entry)
+			s._pending += 1
+			try:
+				if s._executor is None:
+					s._start()
+				future = s._executor.submit(parseIDL, topic, raw, validate)
+			except Exception as e:
+				entry[1] = (None, f"{topic}: cannot parse IDL: {e}")
+				s._deliver(topic)
+				return
+			s._futures.add(future)
+		future.add_done_callback(lambda f: s._done(topic, entry, f))
+
+	def _done(s, topic, entry, future):
+		try:
+			res = future.result()
+		except Exception as e:
+			res = (None, f"{topic}: cannot parse IDL: {e!r}")
+		with s._mutex:
+			s._futures.discard(future)
+			if s._closed: return
+			entry[1] = res
+			s._deliver(topic)
+
+	def _deliver(s, topic):
+		# a result only goes out once everything submitted before it for the same
+		# topic did
+		queue = s._queues[topic]
+		while len(queue) > 0 and queue[0][1] is not None:
+			tag, (l, error) = queue.popleft()
+			s._pending -= 1
+			s._callback(topic, l, error, tag)
+		if len(queue) < 1:
+			del s._queues[topic]
+
+	def close(s):
+		with s._mutex:
+			s._closed = True
+			futures = list(s._futures)
+		for future in futures:
+			future.cancel()
+		if s._executor is not None:
+			s._executor.shutdown(wait=False)
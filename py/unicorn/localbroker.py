@@ -0,0 +1,233 @@
+# Copyright 2022 Peter Wagener <mail@peterwagener.net>
+#
+# This file is part of the Unicorn framework.
+#
+# Unicorn is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Unicorn is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Unicorn. If not, see <https://www.gnu.org/licenses/>.
+
+
+# Local stand-in for an MQTT 3.1.1 broker, enough for load testing the shell
+# and services against a simulated fleet: QoS 0 delivery (QoS 1 publishes are
+# acknowledged and delivered at QoS 0), retained messages, wildcards and last
+# will messages. No persistent sessions, authentication or keepalive checks.
+
+import sys
+import struct
+import asyncio
+from collections import defaultdict
+
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+SUBSCRIBE = 8
+SUBACK = 9
+UNSUBSCRIBE = 10
+UNSUBACK = 11
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+
+def topic_match(flt, topic):
+	levels = topic.split("/")
+	for i, pat in enumerate(flt.split("/")):
+		if pat == "#": return True
+		if i >= len(levels): return False
+		if pat != "+" and pat != levels[i]: return False
+	return len(flt.split("/")) == len(levels)
+
+
+def encode_length(length):
+	res = bytearray()
+	while True:
+		b = length % 128
+		length //= 128
+		res.append(b | 128 if length > 0 else b)
+		if length < 1: return bytes(res)
+
+
+def encode_string(v):
+	if isinstance(v, str):
+		v = v.encode()
+	return struct.pack(">H", len(v)) + v
+
+
+def decode_string(body, pos):
+	n = struct.unpack(">H", body[pos:pos + 2])[0]
+	return body[pos + 2:pos + 2 + n], pos + 2 + n
+
+
+def packet(kind, body=b"", flags=0):
+	return bytes([kind << 4 | flags]) + encode_length(len(body)) + body
+
+
+def publish_packet(topic, payload, retain=False):
+	if isinstance(payload, str):
+		payload = payload.encode()
+	return packet(PUBLISH, encode_string(topic) + payload, 1 if retain else 0)
+
+
+async def read_packet(reader):
+	header = (await reader.readexactly(1))[0]
+	length = 0
+	mult = 1
+	while True:
+		b = (await reader.readexactly(1))[0]
+		length += (b & 127) * mult
+		mult *= 128
+		if not b & 128: break
+	return header, await reader.readexactly(length)
+
+
+class Session:
+	def __init__(s, writer):
+		s.writer = writer
+		s.filters = set()
+		s.will = None
+
+	def send(s, topic, payload, retain=False):
+		s.writer.write(publish_packet(topic, payload, retain))
+
+
+class LocalBroker:
+	def __init__(s):
+		s.retained = dict()
+		s.exact = defaultdict(set)
+		s.wild = defaultdict(set)
+		s.sessions = set()
+		s.server = None
+		s.port = None
+		s.routed = 0
+
+	async def start(s, host="127.0.0.1", port=0):
+		s.server = await asyncio.start_server(s.handle, host, port)
+		s.port = s.server.sockets[0].getsockname()[1]
+		return s.port
+
+	def close(s):
+		if s.server is not None:
+			s.server.close()
+		for session in list(s.sessions):
+			session.writer.close()
+
+	def subscribers(s, topic):
+		# exact filters are a dict lookup, only wildcard filters are matched one
+		# by one
+		res = set(s.exact.get(topic, ()))
+		for flt, sessions in s.wild.items():
+			if topic_match(flt, topic):
+				res |= sessions
+		return res
+
+	def publish(s, topic, payload, retain=False):
+		if retain:
+			if len(payload) > 0:
+				s.retained[topic] = payload
+			else:
+				s.retained.pop(topic, None)
+		for session in s.subscribers(topic):
+			session.send(topic, payload)
+			s.routed += 1
+
+	def subscribe(s, session, flt):
+		session.filters.add(flt)
+		if "+" in flt or "#" in flt:
+			s.wild[flt].add(session)
+		else:
+			s.exact[flt].add(session)
+
+	def unsubscribe(s, session, flt):
+		session.filters.discard(flt)
+		index = s.wild if "+" in flt or "#" in flt else s.exact
+		if flt in index:
+			index[flt].discard(session)
+			if len(index[flt]) < 1:
+				del index[flt]
+
+	def connect(s, session, body):
+		_, pos = decode_string(body, 0)
+		flags = body[pos + 1]
+		_, pos = decode_string(body, pos + 4)
+		if flags & 0x04:
+			topic, pos = decode_string(body, pos)
+			message, pos = decode_string(body, pos)
+			session.will = (topic.decode(), message, bool(flags & 0x20))
+		session.writer.write(packet(CONNACK, b"\x00\x00"))
+
+	async def handle(s, reader, writer):
+		session = Session(writer)
+		s.sessions.add(session)
+		clean = False
+		try:
+			while True:
+				header, body = await read_packet(reader)
+				kind = header >> 4
+				if kind == CONNECT:
+					s.connect(session, body)
+				elif kind == PUBLISH:
+					topic, pos = decode_string(body, 0)
+					if (header >> 1) & 3:
+						writer.write(packet(PUBACK, body[pos:pos + 2]))
+						pos += 2
+					s.publish(topic.decode(), body[pos:], bool(header & 1))
+				elif kind == SUBSCRIBE:
+					pos = 2
+					filters = list()
+					while pos < len(body):
+						flt, pos = decode_string(body, pos)
+						pos += 1
+						filters.append(flt.decode())
+					writer.write(packet(SUBACK, body[:2] + b"\x00" * len(filters)))
+					for flt in filters:
+						s.subscribe(session, flt)
+					# retained messages follow the SUBACK, as with real brokers
+					for topic, payload in list(s.retained.items()):
+						if any(topic_match(flt, topic) for flt in filters):
+							session.send(topic, payload, True)
+				elif kind == UNSUBSCRIBE:
+					pos = 2
+					while pos < len(body):
+						flt, pos = decode_string(body, pos)
+						s.unsubscribe(session, flt.decode())
+					writer.write(packet(UNSUBACK, body[:2]))
+				elif kind == PINGREQ:
+					writer.write(packet(PINGRESP))
+				elif kind == DISCONNECT:
+					clean = True
+					break
+				await writer.drain()
+		except (asyncio.IncompleteReadError, ConnectionError) as e:
+			pass
+		finally:
+			s.sessions.discard(session)
+			for flt in list(session.filters):
+				s.unsubscribe(session, flt)
+			if not clean and session.will is not None:
+				s.publish(*session.will)
+			writer.close()
+
+
+async def serve(host, port):
+	broker = LocalBroker()
+	await broker.start(host, port)
+	sys.stderr.write(f"listening on {host}:{broker.port}\n")
+	async with broker.server:
+		await broker.server.serve_forever()
+
+
+if __name__ == "__main__":
+	port = int(sys.argv[1]) if len(sys.argv) > 1 else 1883
+	try:
+		asyncio.run(serve("127.0.0.1", port))
+	except KeyboardInterrupt:
+		pass
@@ -0,0 +1,72 @@
+# Copyright 2022 Peter Wagener <mail@peterwagener.net>
+#
+# This file is part of the Unicorn framework.
+#
+# Unicorn is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Unicorn is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Unicorn. If not, see <https://www.gnu.org/licenses/>.
+
+# Minimal entry point answering `conglos ... --options` from the IDL cache.
+# Shell completion runs this on every tab press, so it must not import the
+# networking or terminal modules the interactive shell needs.
+
+import os
+import shlex
+import sys
+
+# flags shell.run consumes without adding them to the command line
+shell_flags = {"--dmenu-tree", "--cached", "--on-demand"}
+shell_flag_prefixes = ("--dmenu-idle=", "--broker=", "--timeout=", "--scope=",
+                       "--idl-workers=")
+
+
+def print_options(command_line, f):
+	from . import shell
+	cmdline_str = shell.join_command_line(command_line) + " "
+
+	try:
+		f.write(" ".join(
+		  shlex.quote(v) for v in shell.complete_command(cmdline_str)) + "\n")
+	except SyntaxError as e:
+		pass
+	f.flush()
+
+
+def main(argv=None, fn_cache=None, scopes=None):
+	if argv is None:
+		argv = sys.argv[1:]
+
+	command_line = list()
+	cli_scopes = list()
+	for arg in argv:
+		if arg == "--options":
+			break
+		elif arg in {"-h", "--help", "--"}:
+			return None
+		elif arg.startswith("--scope="):
+			cli_scopes.append(arg[8:])
+			continue
+		elif arg in shell_flags or arg.startswith(shell_flag_prefixes):
+			continue
+		command_line.append(arg)
+	else:
+		return None
+
+	from . import shell
+	# scopes filter the cache as it is loaded, same as in shell.run
+	if len(cli_scopes) > 0:
+		shell.set_scopes(cli_scopes)
+	elif scopes is not None:
+		shell.set_scopes(scopes)
+	if fn_cache is not None and os.path.exists(fn_cache):
+		shell.load_cache(fn_cache)
+	print_options(command_line, sys.stdout)
+	return 0
@@ -0,0 +1,247 @@
+# Copyright 2022 Peter Wagener <mail@peterwagener.net>
+#
+# This file is part of the Unicorn framework.
+#
+# Unicorn is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Unicorn is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Unicorn. If not, see <https://www.gnu.org/licenses/>.
+
+
+# Rollup service: subscribes to every topic described by a measurement IDL and
+# publishes min/max/mean/count per quantity over tumbling windows to
+# <prefix>/<topic>, each described by a measurement IDL of its own. Consumers
+# read one message per window instead of every sample.
+
+import sys
+import math
+import time
+import json
+import threading
+import importlib.util
+from . import idl
+
+# numpy (the rollup extra) reduces large windows faster, the builtins do fine
+# without it
+has_numpy = importlib.util.find_spec("numpy") is not None
+
+stats = ("min", "max", "mean", "count")
+
+
+def summarize(values):
+	if has_numpy:
+		import numpy
+		a = numpy.asarray(values, dtype=float)
+		return float(a.min()), float(a.max()), float(a.mean()), len(a)
+	return min(values), max(values), math.fsum(values) / len(values), len(values)
+
+
+def format_window(columns):
+	fields = list()
+	for values in columns:
+		if len(values) < 1:
+			fields += ["nan", "nan", "nan", "0"]
+			continue
+		vmin, vmax, vmean, count = summarize(values)
+		fields += [f"{vmin:.10g}", f"{vmax:.10g}", f"{vmean:.10g}", str(count)]
+	return " ".join(fields)
+
+
+class Series:
+	# samples of one measurement topic in the current window, one list of values
+	# per quantity
+	def __init__(s, m):
+		s.idl = m
+		s.columns = [list() for _ in m.columns]
+
+	def add(s, payload):
+		for values, tok in zip(s.columns, payload.split()):
+			try:
+				v = float(tok)
+			except ValueError:
+				continue
+			if math.isfinite(v):
+				values.append(v)
+
+	def take(s):
+		res = s.columns
+		s.columns = [list() for _ in res]
+		return res
+
+
+class Rollup:
+	def __init__(s, client, window=60.0, prefix=None, scopes=None, validate=True):
+		s.client = client
+		s.window = window
+		s.prefix = f"rollup/{window:g}s" if prefix is None else prefix.rstrip("/")
+		s.scopes = ["#"] if scopes is None else scopes
+		s.validate = validate
+		s.series = dict()
+		s.mutex = threading.Lock()
+
+	def derived(s, topic):
+		return f"{s.prefix}/{topic}"
+
+	def derived_idl(s, m):
+		columns = list()
+		for name, unit in m.columns:
+			for stat in stats:
+				columns.append((f"{name or 'value'}_{stat}",
+				                "1" if stat == "count" else unit))
+		return idl.Measurement(s.derived(m.topic), columns)
+
+	def on_connect(s, client, userdata, flags, rc):
+		if rc != 0: return
+		client.subscribe([("/unicorn/idl/" + scope, 0) for scope in s.scopes])
+		with s.mutex:
+			topics = list(s.series)
+		if len(topics) > 0:
+			client.subscribe([(topic, 0) for topic in topics])
+
+	def on_message(s, client, userdata, msg):
+		if msg.topic.startswith("/unicorn/idl/"):
+			s.on_idl(msg.topic[13:], msg.payload)
+			return
+		with s.mutex:
+			series = s.series.get(msg.topic, None)
+			if series is not None:
+				series.add(msg.payload.decode(errors="replace"))
+
+	def on_idl(s, topic, payload):
+		# never roll up our own aggregates
+		if topic == s.prefix or topic.startswith(s.prefix + "/"): return
+
+		m = None
+		if len(payload) > 0:
+			try:
+				data = json.loads(payload.decode())
+				if isinstance(data, dict) and "measurement" in data:
+					m = idl.Measurement.FromJSON(topic, data, validate=s.validate)
+			except (UnicodeDecodeError, json.JSONDecodeError) as e:
+				return
+			except Exception as e:
+				print(f"invalid measurement IDL for topic {topic}: {e}")
+				return
+
+		with s.mutex:
+			old = s.series.get(topic, None)
+			if m is None:
+				if old is None: return
+				del s.series[topic]
+			elif old is not None and old.idl.columns == m.columns:
+				# retained replay after a reconnect, keep the window going
+				return
+			else:
+				s.series[topic] = Series(m)
+
+		if m is None:
+			s.client.unsubscribe(topic)
+			s.client.publish("/unicorn/idl/" + s.derived(topic), b"", retain=True)
+			return
+		if old is None:
+			s.client.subscribe(topic)
+		s.client.publish("/unicorn/idl/" + s.derived(topic),
+		                 s.derived_idl(m).toJSON(),
+		                 retain=True)
+
+	def flush(s):
+		with s.mutex:
+			windows = [(topic, series.take()) for topic, series in s.series.items()]
+		for topic, columns in windows:
+			if not any(len(values) > 0 for values in columns): continue
+			s.client.publish(s.derived(topic), format_window(columns))
+
+	def run(s):
+		# windows are aligned to multiples of their length, so several rollup
+		# instances agree on the boundaries
+		while True:
+			now = time.time()
+			time.sleep((math.floor(now / s.window) + 1) * s.window - now)
+			s.flush()
+
+
+def print_help(f):
+	f.write("unicorn-rollup [options]\n"
+	        "options:\n"
+	        "  -h|--help\n"
+	        "    print this help text and exit normally\n"
+	        "  --broker=<host>[:<port>]\n"
+	        "    broker to connect to\n"
+	        "  --window=<seconds>\n"
+	        "    length of the tumbling window, default 60\n"
+	        "  --prefix=<topic>\n"
+	        "    publish aggregates below this topic, default rollup/<window>s\n"
+	        "  --scope=<topic filter>\n"
+	        "    only roll up IDLs below this topic, may be given multiple times\n"
+	        "  --no-validate\n"
+	        "    do not validate measurement IDLs against the schema\n"
+	        "windows are reduced with numpy when it is installed, e.g. through\n"
+	        "pip install unicorn[rollup], and with the builtins otherwise\n")
+	f.flush()
+
+
+def main(argv=None, mqtt_host="mqtt", mqtt_port=1883):
+	if argv is None:
+		argv = sys.argv[1:]
+
+	window = 60.0
+	prefix = None
+	scopes = list()
+	validate = True
+	for arg in argv:
+		try:
+			if arg in {"-h", "--help"}:
+				print_help(sys.stdout)
+				return 0
+			elif arg.startswith("--broker="):
+				host, sep, port = arg[9:].rpartition(":")
+				if sep and port.isdigit():
+					mqtt_host, mqtt_port = host, int(port)
+				else:
+					mqtt_host = arg[9:]
+			elif arg.startswith("--window="):
+				window = float(arg[9:])
+				if window <= 0: raise ValueError(arg[9:])
+			elif arg.startswith("--prefix="):
+				prefix = arg[9:]
+			elif arg.startswith("--scope="):
+				scope = arg[8:]
+				scopes.append(scope if "+" in scope or "#" in scope else
+				              scope.rstrip("/") + "/#")
+			elif arg == "--no-validate":
+				validate = False
+			else:
+				raise ValueError(arg)
+		except ValueError as e:
+			print_help(sys.stderr)
+			sys.stderr.write("\x1b[31;1mError\x1b[30;0m: invalid argument %s\n" % arg)
+			return 1
+
+	import paho.mqtt.client as mqtt
+	client = mqtt.Client()
+	rollup = Rollup(client,
+	                window=window,
+	                prefix=prefix,
+	                scopes=scopes if len(scopes) > 0 else None,
+	                validate=validate)
+	client.on_connect = rollup.on_connect
+	client.on_message = rollup.on_message
+	client.connect_async(mqtt_host, mqtt_port, 60)
+	client.loop_start()
+	try:
+		rollup.run()
+	except KeyboardInterrupt:
+		pass
+	client.loop_stop()
+	return 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -16,26 +16,73 @@
 
 import sys
 import os
+import re
 import time
 import shlex
-import readline
+import fnmatch
 import threading
-from collections import namedtuple, defaultdict
-import paho.mqtt.client as mqtt
+from collections import namedtuple, defaultdict, OrderedDict, deque
 import json
-from . import autocomplete, idl
-import traceback
-import subprocess
-import socks
-import uuid
-import socket
-import jsonschema
+from . import autocomplete, idl, options
 
+# paho.mqtt, socks, jsonschema, readline, uuid and traceback are imported where
+# they are used: --options is answered from the cache on every shell tab press
+# and must not pay for the networking stack.
+
+# grammar key -> IDL and broker name. a key is the IDL topic, unless several
+# brokers serve the same topic: then each copy is keyed <broker>/<topic>
 topic_idl_map = dict()
+topic_broker_map = dict()
+# IDL topic -> {broker name: IDL}, and the keys it currently occupies
+idl_sources = defaultdict(dict)
+idl_keys = dict()
+# cache entries outside the scopes, written back as read so a scoped session
+# does not shrink the cache other sessions share
+cache_out_of_scope = dict()
 lang = autocomplete.Keyword()
+lang_completer = autocomplete.Completer(lang)
 mqtt_client = None
 
+mqtt_host = "mqtt"
+mqtt_port = 1883
+mqtt_proxy = None
+fn_cache = None
+
+mqtt_brokers = OrderedDict()
+
+idl_activity = None
+idl_activity_cond = threading.Condition()
+
+# worker processes parsing incoming IDLs, None uses one per core and 0 parses
+# them on the network thread
+idl_workers = None
+idl_parser = None
+
+# IDL subtrees to subscribe to, as topic filters below /unicorn/idl/. None
+# subscribes to everything
+idl_scopes = None
+
+# in on-demand mode devices are learned from /unicorn/active/ and their IDLs
+# are only fetched once completion or decode_command walks into them
+demand_mode = False
+demand_timeout = 2.0
+demand_idle = 0.2
+demand_devices = dict()
+demand_idls = defaultdict(dict)
+demand_activity = dict()
+demand_inflight = defaultdict(int)
+demand_fetched = dict()
+demand_cond = threading.Condition()
+
+# reconnect backoff bounds and timeouts, all in seconds
+reconnect_delay_min = 0.5
+reconnect_delay_max = 30.0
+suback_timeout = 5.0
+command_timeout = 30.0
+fanout_timeout = None
+
 mqtt_mid_pool = set()
+mqtt_mid_pool_epochs = defaultdict(int)
 mqtt_mid_pool_mutex = threading.Lock()
 mqtt_mid_pool_cond = threading.Condition(mqtt_mid_pool_mutex)
 
@@ -47,18 +94,345 @@ def mqtt_mid_pool_add(mid):
 		mqtt_mid_pool_cond.notify_all()
 
 
-def mqtt_mid_pool_wait(*mids):
+def mqtt_mid_pool_reset(name):
+	# a lost connection never acknowledges its outstanding mids. wake up anyone
+	# waiting for them, on_connect takes care of subscribing again
 	global mqtt_mid_pool
 	with mqtt_mid_pool_mutex:
+		mqtt_mid_pool_epochs[name] += 1
+		mqtt_mid_pool = {mid for mid in mqtt_mid_pool if mid[0] != name}
+		mqtt_mid_pool_cond.notify_all()
+
+
+def mqtt_mid_pool_wait(*mids, timeout=None):
+	global mqtt_mid_pool
+	deadline = None if timeout is None else time.monotonic() + timeout
+	with mqtt_mid_pool_mutex:
+		epochs = {name: mqtt_mid_pool_epochs[name] for name, _ in mids}
 		for mid in mids:
 			while mid not in mqtt_mid_pool:
-				mqtt_mid_pool_cond.wait()
+				if mqtt_mid_pool_epochs[mid[0]] != epochs[mid[0]]:
+					return False
+				if deadline is None:
+					mqtt_mid_pool_cond.wait()
+					continue
+				remaining = deadline - time.monotonic()
+				if remaining <= 0:
+					return False
+				mqtt_mid_pool_cond.wait(remaining)
 			mqtt_mid_pool.remove(mid)
+	return True
+
+
+class Broker:
+	def __init__(s, host, port=1883, name=None):
+		s.host = host
+		s.port = port
+		if name is None:
+			name = host if port == 1883 else f"{host}:{port}"
+		s.name = name
+		s.client = None
+		s.online = threading.Event()
+		s.pending = list()
+		s.expired_deadline = None
+
+	@classmethod
+	def FromSpec(cls, spec):
+		if isinstance(spec, Broker):
+			return spec
+		if isinstance(spec, (tuple, list)):
+			return Broker(*spec)
+		host, sep, port = spec.rpartition(":")
+		if not sep or not port.isdigit():
+			return Broker(spec)
+		return Broker(host, int(port))
+
+	@property
+	def connected(s):
+		return s.online.is_set()
+
+	def start(s):
+		# every broker runs its own network thread, so a slow or unreachable
+		# broker does not hold up the others
+		s.client = mqtt_new_client(userdata=s)
+		s.client.on_connect = on_connect
+		s.client.on_disconnect = on_disconnect
+		s.client.on_message = on_message
+		s.client.on_subscribe = on_subscribe
+		s.client.connect_async(s.host, s.port, 60)
+		threading.Thread(target=s.run, daemon=True).start()
+
+	def run(s):
+		# we drive the network loop ourselves instead of loop_start: paho retries
+		# on a fixed exponential schedule, which makes every shell behind a
+		# dropped broker come back in lockstep
+		delay = reconnect_delay_min
+		while True:
+			try:
+				s.client.reconnect()
+			except OSError:
+				s.backoff(delay)
+				delay = min(delay * 2, reconnect_delay_max)
+				continue
+			since = time.monotonic()
+			while s.client.loop(1.0) == 0:
+				s.expire()
+			# only a link that stayed up for a while earns a fast retry, a flapping
+			# one keeps backing off
+			if time.monotonic() - since >= reconnect_delay_max:
+				delay = reconnect_delay_min
+			s.backoff(delay)
+			delay = min(delay * 2, reconnect_delay_max)
+
+	def backoff(s, delay):
+		import random
+		wake = time.monotonic() + random.uniform(delay / 2, delay)
+		while True:
+			s.expire()
+			remaining = wake - time.monotonic()
+			if remaining <= 0: return
+			time.sleep(min(remaining, 1.0))
+
+	def defer(s, cmdline, deadline=None):
+		if deadline is None:
+			deadline = time.monotonic() + command_timeout
+		with ev_mutex:
+			s.pending.append((deadline, cmdline))
+
+	def take_pending(s):
+		s.expire()
+		with ev_mutex:
+			res = s.pending
+			s.pending = list()
+		return res
+
+	def expire(s):
+		# runs on the network thread, so it only notices expiry. the main loop
+		# reports it and clears the response topics
+		now = time.monotonic()
+		with ev_mutex:
+			expired = [cmdline for deadline, cmdline in s.pending if deadline <= now]
+			s.pending = [(deadline, cmdline) for deadline, cmdline in s.pending
+			             if deadline > now]
+			deadline = None
+			if topic_broker is s and topic_deadline is not None \
+			  and topic_deadline <= now and topic_deadline != s.expired_deadline:
+				deadline = s.expired_deadline = topic_deadline
+			if len(expired) > 0 or deadline is not None:
+				ev_push(EV_EXPIRED, (s, expired, deadline))
+
+
+def configure(host,
+              port,
+              proxy,
+              cache,
+              brokers=None,
+              scopes=None,
+              on_demand=False):
+	global mqtt_host, mqtt_port, mqtt_proxy, fn_cache, demand_mode
+	mqtt_host = host
+	mqtt_port = port
+	mqtt_proxy = proxy
+	fn_cache = cache
+	set_brokers([(host, port)] if brokers is None else brokers)
+	set_scopes(scopes)
+	demand_mode = on_demand
+
+
+def set_scopes(scopes):
+	global idl_scopes
+	if scopes is None:
+		idl_scopes = None
+		return
+	# a plain subtree name covers everything below it
+	idl_scopes = [
+	  scope if "+" in scope or "#" in scope else scope.rstrip("/") + "/#"
+	  for scope in scopes
+	]
+
+
+def in_scope(topic):
+	if idl_scopes is None: return True
+	return any(topic_glob_match(scope, topic) for scope in idl_scopes)
+
+
+def device_in_scope(device):
+	if idl_scopes is None: return True
+	for scope in idl_scopes:
+		head = scope.split("/")[0]
+		if head in {"+", "#"} or fnmatch.fnmatchcase(device, head): return True
+	return False
+
+
+def idl_filters(broker):
+	if demand_mode:
+		# keep the devices we already have IDLs for up to date, the rest waits
+		# until it is used. this runs on the network thread, demand_fetch may
+		# be changing demand_fetched meanwhile
+		with demand_cond:
+			fetched = list(demand_fetched)
+		devices = {device for device in fetched
+		           if demand_devices.get(device, None) == broker.name}
+		devices.update(topic.split("/")[0]
+		               for topic, sources in list(idl_sources.items())
+		               if broker.name in sources)
+		return ["/unicorn/active/#"] + [
+		  f"/unicorn/idl/{device}/#" for device in sorted(devices)
+		]
+	if idl_scopes is None:
+		return ["/unicorn/idl/#"]
+	return ["/unicorn/idl/" + scope for scope in idl_scopes]
+
+
+def set_brokers(specs):
+	mqtt_brokers.clear()
+	for spec in specs:
+		broker = Broker.FromSpec(spec)
+		mqtt_brokers[broker.name] = broker
+
+
+def broker_named(name):
+	if len(mqtt_brokers) < 1:
+		set_brokers([(mqtt_host, mqtt_port)])
+	if name in mqtt_brokers:
+		return mqtt_brokers[name]
+	return next(iter(mqtt_brokers.values()))
+
+
+def broker_for(prefix):
+	return broker_named(None if prefix is None else prefix.broker)
+
+
+def start_brokers(timeout=None):
+	for broker in mqtt_brokers.values():
+		broker.start()
+	if timeout is None: return
+	deadline = time.monotonic() + timeout
+	for broker in mqtt_brokers.values():
+		broker.online.wait(max(0, deadline - time.monotonic()))
+
+
+def wait_any_connected(timeout):
+	# brokers connect in the background and retry forever, give up waiting once
+	# none of them made it within timeout
+	deadline = time.monotonic() + timeout
+	while not any(broker.connected for broker in mqtt_brokers.values()):
+		remaining = deadline - time.monotonic()
+		if remaining <= 0: return False
+		time.sleep(min(remaining, 0.05))
+	return True
+
+
+def idl_touch():
+	global idl_activity
+	with idl_activity_cond:
+		idl_activity = time.monotonic()
+		idl_activity_cond.notify_all()
+
+
+def idl_wait_idle(idle):
+	with idl_activity_cond:
+		while True:
+			if idl_activity is None or (idl_parser is not None
+			                            and idl_parser.pending > 0):
+				idl_activity_cond.wait()
+				continue
+			remaining = idl_activity + idle - time.monotonic()
+			if remaining <= 0: return
+			idl_activity_cond.wait(remaining)
+
+
+class DemandNode(autocomplete.Node):
+	def __init__(s, device):
+		autocomplete.Node.__init__(s)
+		s.device = device
+
+	def complete(s, toks):
+		root, _ = build_grammar([(l.topic, broker, l)
+		                         for broker, l in demand_fetch(s.device)],
+		                        PrefixMode())
+		if s.device in root._stmts:
+			yield from root._stmts[s.device].complete(toks)
+
+	def _fields(s):
+		return None
+
 
+def demand_begin(device):
+	with demand_cond:
+		demand_inflight[device] += 1
 
-def mid_add(mids, res):
+
+def demand_end(device):
+	with demand_cond:
+		demand_inflight[device] -= 1
+		demand_activity[device] = time.monotonic()
+		demand_cond.notify_all()
+
+
+def demand_stage(broker, l):
+	with demand_cond:
+		demand_idls[l.topic.split("/")[0]][(broker, l.topic)] = (broker, l)
+
+
+def demand_fetch(device):
+	with demand_cond:
+		fetched = demand_fetched.get(device, None)
+		first = fetched is None
+		if first:
+			fetched = demand_fetched[device] = threading.Event()
+
+	if not first:
+		fetched.wait(demand_timeout)
+	else:
+		broker = broker_named(demand_devices.get(device, None))
+		deadline = time.monotonic() + demand_timeout
+		if broker.connected:
+			mids = set()
+			mid_add(mids, broker.client.subscribe(f"/unicorn/idl/{device}/#"), broker)
+			mqtt_mid_pool_wait(*mids, timeout=demand_timeout)
+		start = time.monotonic()
+		with demand_cond:
+			if not broker.connected:
+				# try again next time
+				del demand_fetched[device]
+			else:
+				# retained IDLs follow the SUBACK, wait for them to settle
+				while True:
+					last = max(start, demand_activity.get(device, start))
+					if demand_inflight[device] > 0:
+						last = deadline
+					remaining = min(last + demand_idle, deadline) - time.monotonic()
+					if remaining <= 0: break
+					demand_cond.wait(remaining)
+		fetched.set()
+
+	with demand_cond:
+		return list(demand_idls[device].values())
+
+
+def demand_done(device):
+	with demand_cond:
+		fetched = demand_fetched.get(device, None)
+		return fetched is not None and fetched.is_set()
+
+
+def demand_resolve(device):
+	if not isinstance(lang._stmts.get(device, None), DemandNode): return
+	idls = demand_fetch(device)
+	if len(idls) > 0:
+		for broker, l in idls:
+			apply_idl(broker, l)
+		build_lang(write_cache=False)
+	elif demand_done(device):
+		# active, but nothing to complete. IDLs it publishes later arrive on the
+		# subscription made by the fetch
+		lang._stmts.pop(device, None)
+
+
+def mid_add(mids, res, broker):
 	_, mid = res
-	mids.add(mid)
+	mids.add((broker.name, mid))
 	pass
 
 
@@ -69,7 +443,8 @@ class PrefixMode(defaultdict):
 	             adhoc_channels=False,
 	             stdout=None,
 	             stderr=None,
-	             result=None):
+	             result=None,
+	             broker=None):
 		defaultdict.__init__(s, lambda: PrefixMode())
 		s.topic = topic
 		s.include_head = include_head
@@ -77,6 +452,7 @@ class PrefixMode(defaultdict):
 		s.stdout = stdout
 		s.stderr = stderr
 		s.result = result
+		s.broker = broker
 
 	def clear(s):
 		defaultdict.clear(s)
@@ -86,30 +462,51 @@ class PrefixMode(defaultdict):
 		s.stdout = None
 		s.stderr = None
 		s.result = None
+		s.broker = None
 
 
 prefix_modes = PrefixMode()
+prefix_depth = 0
 
+decode_cache = OrderedDict()
+decode_cache_size = 256
+decode_cache_mutex = threading.Lock()
 
-def build_lang(write_cache=True):
-	global lang, prefix_modes
-	lang = autocomplete.Keyword()
-	prefix_modes.clear()
-	for l in topic_idl_map.values():
+_shlex_plain = re.compile("[%s]*" % re.escape(
+  shlex.shlex(posix=True, punctuation_chars=True).wordchars + " \t\r\n"))
+_shlex_field = re.compile("[^ \t\r\n]+")
+
+
+def build_grammar(entries, modes):
+	# entries are (key, broker name, IDL). the key spells the keyword path, which
+	# differs from the topic for IDLs served by several brokers
+	root = autocomplete.Keyword()
+	depth = 0
+	for key, broker, l in entries:
 		if l.flat:
 			if not isinstance(l.completion, autocomplete.Keyword): continue
-			lang._stmts.update(l.completion._stmts)
+			parent = root
+			prefix = modes
+			qualifier = key[:-len(l.topic)].rstrip("/")
+			if qualifier:
+				if not isinstance(root._stmts.get(qualifier, None), autocomplete.Keyword):
+					root._stmts[qualifier] = autocomplete.Keyword()
+				parent = root._stmts[qualifier]
+				prefix = modes[qualifier]
+			parent._stmts.update(l.completion._stmts)
 			for k in l.completion._stmts:
-				prefix_modes[k].topic = l.topic
-				prefix_modes[k].include_head = True
-				prefix_modes[k].adhoc_channels = l.adHocChannels
-				prefix_modes[k].stdout = l.stdout
-				prefix_modes[k].stderr = l.stderr
-				prefix_modes[k].result = l.result
+				prefix[k].topic = l.topic
+				prefix[k].include_head = True
+				prefix[k].adhoc_channels = l.adHocChannels
+				prefix[k].stdout = l.stdout
+				prefix[k].stderr = l.stderr
+				prefix[k].result = l.result
+				prefix[k].broker = broker
+			depth = max(depth, 2 if qualifier else 1)
 		else:
-			parent = lang
-			prefix = prefix_modes
-			keywords = l.topic.split("/")
+			parent = root
+			prefix = modes
+			keywords = key.split("/")
 			for kw in keywords[:-1]:
 				if not kw in parent._stmts:
 					parent._stmts[kw] = autocomplete.Keyword()
@@ -127,14 +524,51 @@ def build_lang(write_cache=True):
 			prefix[keywords[-1]].stdout = l.stdout
 			prefix[keywords[-1]].stderr = l.stderr
 			prefix[keywords[-1]].result = l.result
+			prefix[keywords[-1]].broker = broker
+			depth = max(depth, len(keywords))
 
-	if write_cache and fn_cache is not None:
-		with open(fn_cache, "w") as f:
+	return root, depth
 
-			json.dump({k: (v.topic, v.toJSON()) for k, v in topic_idl_map.items()}, f)
 
+def build_lang(write_cache=True):
+	global lang, lang_completer, prefix_modes, prefix_depth
+	prefix_modes.clear()
+	lang, prefix_depth = build_grammar(
+	  [(key, topic_broker_map.get(key, None), l)
+	   for key, l in topic_idl_map.items()], prefix_modes)
+	# devices we only know to be active complete through a placeholder that
+	# fetches their IDLs when first walked
+	for device in demand_devices:
+		if device not in lang._stmts and not demand_done(device):
+			lang._stmts[device] = DemandNode(device)
+
+	lang_completer = autocomplete.Completer(lang)
+	with decode_cache_mutex:
+		decode_cache.clear()
 
-def decode_command(cmdline):
+	if write_cache and fn_cache is not None:
+		write_cache_file(fn_cache)
+
+
+def write_cache_file(fn_cache):
+	os.makedirs(os.path.dirname(os.path.abspath(fn_cache)), exist_ok=True)
+	with open(fn_cache, "w") as f:
+		f.write("{")
+		for i, (k, v) in enumerate(topic_idl_map.items()):
+			if i > 0: f.write(", ")
+			broker = topic_broker_map.get(k, None)
+			f.write(f"{json.dumps(k)}: [{json.dumps(v.topic)}, "
+			        f"{json.dumps(v.toJSON())}, {json.dumps(broker)}]")
+		first = len(topic_idl_map) < 1
+		for k, entry in cache_out_of_scope.items():
+			if k in topic_idl_map: continue
+			if not first: f.write(", ")
+			first = False
+			f.write(f"{json.dumps(k)}: {json.dumps(entry)}")
+		f.write("}")
+
+
+def decode_prefix_scan(cmdline):
 	scanner = shlex.shlex(cmdline, posix=True, punctuation_chars=True)
 	prefix = prefix_modes
 	longest_prefix = None
@@ -147,6 +581,49 @@ def decode_command(cmdline):
 		prefix = prefix[tok]
 		if prefix.topic is not None:
 			longest_prefix = (pos, scanner.instream.tell(), prefix)
+	return longest_prefix
+
+
+def decode_prefix_fields(cmdline):
+	# plain command lines tokenize like str.split, and only the first
+	# prefix_depth fields can ever match prefix_modes, so they key the cache
+	fields = list()
+	for m in _shlex_field.finditer(cmdline):
+		if len(fields) >= prefix_depth: break
+		fields.append(m)
+	key = cmdline[:fields[-1].end()] if len(fields) > 0 else ""
+
+	with decode_cache_mutex:
+		if key in decode_cache:
+			decode_cache.move_to_end(key)
+			return decode_cache[key]
+
+	prefix = prefix_modes
+	longest_prefix = None
+	for m in fields:
+		if not m.group() in prefix:
+			break
+		prefix = prefix[m.group()]
+		if prefix.topic is not None:
+			longest_prefix = (m.start(), m.end(), prefix)
+
+	with decode_cache_mutex:
+		decode_cache[key] = longest_prefix
+		while len(decode_cache) > decode_cache_size:
+			decode_cache.popitem(last=False)
+	return longest_prefix
+
+
+def decode_command(cmdline):
+	if demand_mode:
+		m = _shlex_field.search(cmdline)
+		if m is not None:
+			demand_resolve(m.group())
+
+	if _shlex_plain.fullmatch(cmdline):
+		longest_prefix = decode_prefix_fields(cmdline)
+	else:
+		longest_prefix = decode_prefix_scan(cmdline)
 
 	if longest_prefix is None: return
 	pos_pre, pos_post, prefix = longest_prefix
@@ -154,6 +631,7 @@ def decode_command(cmdline):
 	param = cmdline[pos:].strip()
 
 	if prefix.adhoc_channels:
+		import uuid
 		suffix = "/" + str(uuid.uuid4())
 	else:
 		suffix = ""
@@ -161,11 +639,28 @@ def decode_command(cmdline):
 	return prefix, prefix.topic + suffix, param, suffix
 
 
-def process_command(client, cmdline):
+def mqtt_new_client(**kwargs):
+	import paho.mqtt.client as mqtt
+	client = mqtt.Client(**kwargs)
+	if mqtt_proxy is not None:
+		import socks
+		import socket
+		# set proxy ONLY after client build but after connect
+		socks.setdefaultproxy(socks.PROXY_TYPE_SOCKS4, *mqtt_proxy)
+		socket.socket = socks.socksocket
+	return client
+
+
+def process_command(client, cmdline, deadline=None):
+	if cmdline.lstrip().startswith("@"):
+		process_fanout(cmdline, println)
+		return
+
 	raw = decode_command(cmdline)
 	if raw is None: return
 
 	prefix, topic, payload, suffix = raw
+	broker = broker_for(prefix)
 
 	if client is None:
 
@@ -182,22 +677,294 @@ def process_command(client, cmdline):
 			client.disconnect()
 			userdata.stop = True
 
-		client = mqtt.Client(userdata=stopper)
-
-		if mqtt_proxy is not None:
-			# set proxy ONLY after client build but after connect
-			socks.setdefaultproxy(socks.PROXY_TYPE_SOCKS4, *mqtt_proxy)
-			socket.socket = socks.socksocket
+		client = mqtt_new_client(userdata=stopper)
 		client.on_connect = on_connect
 		client.on_publish = on_publish
-		client.connect(mqtt_host, mqtt_port, 60)
+		client.connect(broker.host, broker.port, 60)
 
 		while not stopper.stop:
 			client.loop()
 	else:
+		if broker.connected:
+			if setResponseTopics(prefix.stdout,
+			                     prefix.stderr,
+			                     prefix.result,
+			                     suffix,
+			                     broker=broker,
+			                     deadline=deadline):
+				rc, _ = broker.client.publish(topic, payload)
+				if rc == 0: return
+			setResponseTopics(None, None, None)
+			if broker.connected:
+				# nobody would be listening for the reply
+				println(f"[\x1b[31;1merr\x1b[30;0m]broker {broker.name} did not confirm "
+				        f"the response subscriptions within {suback_timeout:g}s, "
+				        f"command not sent: {cmdline}")
+				return
+
+		# keep the command, and its deadline, until the broker is back
+		broker.defer(cmdline, deadline)
+		println(f"[\x1b[33;1mwait\x1b[30;0m]broker {broker.name} is not connected, "
+		        "command queued")
+
+
+fanout_topics = dict()
+fanout_cond = threading.Condition()
+
+
+class FanoutTarget:
+	def __init__(s, l, broker):
+		s.idl = l
+		s.broker = broker
+		s.status = "pending"
+		s.detail = None
+		s.result = None
+		s.stdout = list()
+		s.stderr = list()
+		s.channels = dict()
+		s.suffix = ""
+
+	@property
+	def done(s):
+		return s.status != "pending"
 
-		setResponseTopics(prefix.stdout, prefix.stderr, prefix.result, suffix)
-		client.publish(topic, payload)
+
+def topic_glob_match(pattern, topic):
+	# MQTT style + and # levels, shell style wildcards within a level
+	levels = topic.split("/")
+	for i, pat in enumerate(pattern.split("/")):
+		if pat == "#": return True
+		if i >= len(levels): return False
+		if pat != "+" and not fnmatch.fnmatchcase(levels[i], pat): return False
+	return len(pattern.split("/")) == len(levels)
+
+
+def fanout_prepare(target, param):
+	try:
+		autocomplete.Completer(target.idl.completion).check(param)
+	except (SyntaxError, ValueError) as e:
+		target.status = "invalid"
+		target.detail = str(e)
+		return
+	if not target.broker.connected:
+		target.status = "offline"
+		return
+
+	if target.idl.adHocChannels:
+		import uuid
+		suffix = "/" + str(uuid.uuid4())
+	else:
+		suffix = ""
+	channels = dict()
+	for kind in ("stdout", "stderr", "result"):
+		topic = getattr(target.idl, kind)
+		if topic is not None:
+			channels[(target.broker.name, topic + suffix)] = kind
+
+	with fanout_cond:
+		if any(key in fanout_topics for key in channels):
+			target.status = "busy"
+			target.detail = "response channel in use"
+			return
+		target.channels = channels
+		target.suffix = suffix
+		for key, kind in channels.items():
+			fanout_topics[key] = (target, kind)
+
+
+def fanout_deliver(name, msg):
+	with fanout_cond:
+		entry = fanout_topics.get((name, msg.topic), None)
+		if entry is None: return
+		target, kind = entry
+		lines = [
+		  ln.rstrip()
+		  for ln in msg.payload.decode(errors="replace").rstrip().splitlines()
+		]
+		if kind == "result":
+			target.result = " ".join(lines)
+			target.status = "ok"
+			fanout_cond.notify_all()
+		else:
+			getattr(target, kind).extend(lines)
+
+
+def process_fanout(cmdline, write):
+	pattern, _, param = cmdline.strip()[1:].partition(" ")
+	param = param.strip()
+	if demand_mode:
+		head = pattern.split("/")[0]
+		for device in list(demand_devices):
+			if head in {"+", "#"} or fnmatch.fnmatchcase(device, head):
+				demand_resolve(device)
+	targets = [
+	  FanoutTarget(l, broker_named(topic_broker_map.get(key, None)))
+	  for key, l in sorted(topic_idl_map.items())
+	  if topic_glob_match(pattern, l.topic)
+	]
+	if len(targets) < 1:
+		write(f"[\x1b[31;1merr\x1b[30;0m]no device matches {pattern}")
+		return None
+
+	for target in targets:
+		fanout_prepare(target, param)
+	live = [target for target in targets if not target.done]
+
+	# a single subscribe per broker, and all SUBACKs awaited together, instead
+	# of one round trip per device
+	mids = dict()
+	for broker in {target.broker for target in live}:
+		topics = [(topic, 0) for target in live if target.broker is broker
+		          for _, topic in target.channels]
+		if len(topics) > 0:
+			mids[broker] = set()
+			mid_add(mids[broker], broker.client.subscribe(topics), broker)
+	suback_deadline = time.monotonic() + suback_timeout
+	for broker, broker_mids in mids.items():
+		remaining = max(0.0, suback_deadline - time.monotonic())
+		if mqtt_mid_pool_wait(*broker_mids, timeout=remaining): continue
+		# replies could not arrive, do not send to the devices behind it
+		with fanout_cond:
+			for target in live:
+				if target.broker is not broker: continue
+				target.status = "offline"
+				target.detail = "response subscriptions not confirmed"
+				for key in target.channels:
+					fanout_topics.pop(key, None)
+	deadline = time.monotonic() + (command_timeout
+	                               if fanout_timeout is None else fanout_timeout)
+
+	for target in live:
+		if target.done: continue
+		rc, _ = target.broker.client.publish(target.idl.topic + target.suffix,
+		                                     param)
+		if rc != 0:
+			target.status = "offline"
+		elif target.idl.result is None:
+			target.status = "sent"
+
+	with fanout_cond:
+		while not all(target.done for target in live):
+			remaining = deadline - time.monotonic()
+			if remaining <= 0: break
+			fanout_cond.wait(remaining)
+		for target in live:
+			if not target.done:
+				target.status = "timeout"
+			for key in target.channels:
+				fanout_topics.pop(key, None)
+
+	for broker in {target.broker for target in live}:
+		topics = [topic for target in live if target.broker is broker
+		          for _, topic in target.channels]
+		if len(topics) > 0 and broker.connected:
+			broker.client.unsubscribe(topics)
+
+	print_fanout(targets, write)
+	return targets
+
+
+def fanout_complete(code):
+	head, sep, rest = code.lstrip().partition(" ")
+	if not sep:
+		return list(
+		  dict.fromkeys("@" + l.topic for l in topic_idl_map.values()
+		                if l.topic.startswith(head[1:])))
+	res = set()
+	for l in topic_idl_map.values():
+		if not topic_glob_match(head[1:], l.topic): continue
+		try:
+			res.update(autocomplete.Completer(l.completion).complete(rest.lstrip()))
+		except SyntaxError as e:
+			pass
+	return res
+
+
+def run_fanout(command_line, idle):
+	start_brokers(timeout=suback_timeout)
+	if any(broker.connected for broker in mqtt_brokers.values()):
+		# pick up devices the cache does not know yet
+		idl_wait_idle(idle)
+		with ev_mutex:
+			while ev_peek() is not None:
+				ev = ev_pop()
+				if ev.kind == EV_IDL_CONFIG:
+					apply_idl(*ev.payload)
+				elif ev.kind == EV_ACTIVE:
+					apply_active(*ev.payload)
+		build_lang(write_cache=False)
+
+	if idl_parser is not None:
+		idl_parser.close()
+
+	targets = process_fanout(join_command_line(command_line), print)
+	if targets is None: return 1
+	return 0 if all(target.status in {"ok", "sent"} for target in targets) else 1
+
+
+def print_fanout(targets, write):
+	header = ["device", "status", "result"]
+	if len(mqtt_brokers) > 1:
+		header.insert(1, "broker")
+	rows = [header]
+	for target in targets:
+		row = [target.idl.topic, target.status, target.result or target.detail or ""]
+		if len(mqtt_brokers) > 1:
+			row.insert(1, target.broker.name)
+		rows.append(row)
+	widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+	for row in rows:
+		write("  ".join(v.ljust(w) for v, w in zip(row, widths)).rstrip())
+
+	for target in targets:
+		for ln in target.stdout:
+			write(f"[\x1b[32;1mout\x1b[30;0m]{target.idl.topic}: {ln}")
+		for ln in target.stderr:
+			write(f"[\x1b[31;1merr\x1b[30;0m]{target.idl.topic}: {ln}")
+
+
+def broker_keyword(name):
+	# broker names are host[:port], keep them to characters a keyword can hold
+	return re.sub(r"[^\w.-]", "_", name)
+
+
+def apply_idl(broker, l, warn=True):
+	sources = idl_sources[l.topic]
+	if broker is None:
+		# cache entries from before brokers were recorded
+		if len(sources) > 0 and None not in sources: return
+	else:
+		sources.pop(None, None)
+	collided = len(sources) == 1 and broker not in sources
+	sources[broker] = l
+
+	for key in idl_keys.pop(l.topic, ()):
+		topic_idl_map.pop(key, None)
+		topic_broker_map.pop(key, None)
+	if len(sources) == 1:
+		keys = {l.topic: broker}
+	else:
+		keys = {
+		  f"{broker_keyword(name)}/{l.topic}": name
+		  for name in sorted(sources)
+		}
+	for key, name in keys.items():
+		topic_idl_map[key] = sources[name]
+		topic_broker_map[key] = name
+	idl_keys[l.topic] = list(keys)
+
+	if collided and warn:
+		sys.stderr.write(f"\x1b[33;1mwarning\x1b[30;0m: {l.topic} is served by "
+		                 f"{', '.join(sorted(sources))}, prefix commands with the "
+		                 "broker name\n")
+		sys.stderr.flush()
+
+
+def apply_active(broker, device, active):
+	if active:
+		demand_devices[device] = broker
+	else:
+		demand_devices.pop(device, None)
 
 
 def load_cache(fn_cache):
@@ -208,15 +975,23 @@ def load_cache(fn_cache):
 			print("error decoding cache")
 			return
 
-	topic_idl_map = dict()
-	for k, (topic, data) in entries:
+	topic_idl_map.clear()
+	topic_broker_map.clear()
+	idl_sources.clear()
+	idl_keys.clear()
+	cache_out_of_scope.clear()
+	for k, entry in entries:
+		topic, data = entry[:2]
+		if not in_scope(topic):
+			cache_out_of_scope[k] = entry
+			continue
+		broker = entry[2] if len(entry) > 2 else None
 		try:
-			topic_idl_map[k] = idl.IDL.FromJSON(topic,
-			                                    json.loads(data),
-			                                    validate=False)
-		except jsonschema.exceptions.ValidationError as e:
+			l = idl.IDL.FromJSON(topic, json.loads(data), validate=False, raw=data)
+		except (KeyError, TypeError, ValueError) as e:
 			# print(f"invalid IDL for topic {topic} (cache)")
-			pass
+			continue
+		apply_idl(broker, l, warn=False)
 	build_lang(write_cache=False)
 
 
@@ -224,15 +999,117 @@ def print_help(f):
 	f.write("conglos [options] [command line] \n"
 	        "options:\n"
 	        "  -h|--help\n"
-	        "    print this help text and exit normally\n")
+	        "    print this help text and exit normally\n"
+	        "  --options\n"
+	        "    print completion options for the command line and exit\n"
+	        "  --dmenu-tree\n"
+	        "    print the command tree in dmenu-tree format and exit. without a\n"
+	        "    reachable broker the cached IDLs are used, exit code 1 if none\n"
+	        "  --dmenu-idle=<seconds>\n"
+	        "    with --dmenu-tree, wait for IDL traffic to be idle this long\n"
+	        "  --cached\n"
+	        "    with --dmenu-tree, use the cached IDLs and do not connect\n"
+	        "  --broker=<host>[:<port>]\n"
+	        "    connect to this broker, may be given multiple times. a topic\n"
+	        "    served by several brokers is prefixed with the broker name\n"
+	        "  --timeout=<seconds>\n"
+	        "    how long to wait for results of a fan-out command, defaults to\n"
+	        "    the command timeout\n"
+	        "  --scope=<topic filter>\n"
+	        "    only load IDLs below this topic, may be given multiple times\n"
+	        "  --on-demand\n"
+	        "    learn devices from /unicorn/active and fetch their IDLs on use\n"
+	        "  --idl-workers=<n>\n"
+	        "    parse incoming IDLs on n processes, 0 parses them in-thread\n"
+	        "fan-out:\n"
+	        "  @<topic pattern> <arguments>\n"
+	        "    send the arguments to every device whose IDL topic matches the\n"
+	        "    pattern and print a summary of their replies. + and # match\n"
+	        "    topic levels, * ? and [...] match within a level. devices\n"
+	        "    without a result channel are reported as sent right away and\n"
+	        "    their output is not shown. the shell waits for the replies,\n"
+	        "    up to --timeout, before it takes the next command\n")
+	f.flush()
+
+
+def dmenu_tree_lines(root):
+	# the tree lists every command, so placeholders have to be fetched first
+	devices = [
+	  device for device, node in root._stmts.items()
+	  if isinstance(node, DemandNode)
+	]
+	if len(devices) > 0:
+		threads = [
+		  threading.Thread(target=demand_fetch, args=(device, ))
+		  for device in devices
+		]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		for device in devices:
+			for broker, l in demand_fetch(device):
+				apply_idl(broker, l)
+		build_lang(write_cache=False)
+		root = lang
+	handled = set()
+
+	def rec(node, cmdline):
+		if node in handled: return
+		handled.add(node)
+		if node is None or isinstance(node, autocomplete.Empty):
+			raw = decode_command(shlex.join(cmdline))
+			if raw is not None:
+				prefix, topic, payload, suffix = raw
+				broker = broker_for(prefix)
+				cmd = ["mosquitto_pub", "-h", broker.host]
+				if broker.port != 1883:
+					cmd += ["-p", str(broker.port)]
+				yield ":output " + shlex.join(cmd + ["-t", topic, "-m", payload])
+
+		elif isinstance(node, autocomplete.Keyword):
+			pushed = False
+			for k, v in node._stmts.items():
+				sub = rec(v, cmdline + [k])
+				first = next(sub, None)
+				if first is None: continue
+				if not pushed and len(cmdline) > 0:
+					yield ":push"
+					pushed = True
+				yield k
+				yield first
+				yield from sub
+			if pushed:
+				yield ":pop"
+
+	yield from rec(root, list())
+
+
+def print_dmenu_tree(f):
+	for ln in dmenu_tree_lines(lang):
+		f.write(ln + "\n")
 	f.flush()
 
 
+def join_command_line(command_line):
+	# a leading fan-out pattern is passed on as is, quoting would hide the @
+	if len(command_line) > 0 and command_line[0].startswith("@"):
+		return " ".join([command_line[0]] +
+		                [shlex.quote(v) for v in command_line[1:]])
+	return " ".join([shlex.quote(v) for v in command_line])
+
+
+def complete_command(code):
+	if code.lstrip().startswith("@"):
+		return fanout_complete(code)
+	return lang_completer.complete(code)
+
+
 def completer(prefix, state):
+	import readline
 
-	toks = autocomplete.TokenStream(readline.get_line_buffer(),
-	                                readline.get_endidx())
-	options = sorted(v for v in lang.complete(toks))
+	options = sorted(
+	  complete_command(readline.get_line_buffer()[:readline.get_endidx()]))
 	if state < len(options):
 		return options[state]
 
@@ -244,6 +1121,10 @@ EV_IDL_STDERR = 1
 EV_IDL_STDOUT = 2
 EV_TERMINATE = 3
 EV_IDL_CONFIG = 4
+EV_DMENU_TREE = 5
+EV_BROKER_CONNECTED = 6
+EV_ACTIVE = 7
+EV_EXPIRED = 8
 
 ev_t = namedtuple("ev_t", "kind payload")
 ev_mutex = threading.RLock()
@@ -253,9 +1134,16 @@ ev_queue = list()
 topic_stdout = None
 topic_stderr = None
 topic_result = None
+topic_broker = None
+topic_deadline = None
 
 
-def setResponseTopics(stdout, stderr, result, suffix=""):
+def setResponseTopics(stdout,
+                      stderr,
+                      result,
+                      suffix="",
+                      broker=None,
+                      deadline=None):
 	if stdout is not None:
 		stdout += suffix
 	if stderr is not None:
@@ -265,27 +1153,35 @@ def setResponseTopics(stdout, stderr, result, suffix=""):
 
 	mids = set()
 
-	global mqtt_client
-
 	with ev_mutex:
-		global topic_stdout, topic_stderr, topic_result
-		if topic_stdout is not None:
-			mqtt_client.unsubscribe(topic_stdout)
-		if topic_stderr is not None:
-			mqtt_client.unsubscribe(topic_stderr)
-		if topic_result is not None:
-			mqtt_client.unsubscribe(topic_result)
+		global topic_stdout, topic_stderr, topic_result, topic_broker, topic_deadline
+		if topic_broker is not None:
+			client = topic_broker.client
+			if topic_stdout is not None:
+				client.unsubscribe(topic_stdout)
+			if topic_stderr is not None:
+				client.unsubscribe(topic_stderr)
+			if topic_result is not None:
+				client.unsubscribe(topic_result)
 		topic_stdout = stdout
 		topic_stderr = stderr
 		topic_result = result
+		topic_broker = broker if broker is not None else broker_for(None)
+		if result is None:
+			topic_deadline = None
+		elif deadline is None:
+			topic_deadline = time.monotonic() + command_timeout
+		else:
+			topic_deadline = deadline
+		client = topic_broker.client
 		if topic_stdout is not None:
-			mid_add(mids, mqtt_client.subscribe(topic_stdout))
+			mid_add(mids, client.subscribe(topic_stdout), topic_broker)
 		if topic_stderr is not None:
-			mid_add(mids, mqtt_client.subscribe(topic_stderr))
+			mid_add(mids, client.subscribe(topic_stderr), topic_broker)
 		if topic_result is not None:
-			mid_add(mids, mqtt_client.subscribe(topic_result))
+			mid_add(mids, client.subscribe(topic_result), topic_broker)
 
-	mqtt_mid_pool_wait(*mids)
+	return mqtt_mid_pool_wait(*mids, timeout=suback_timeout)
 
 
 def ev_push(kind, payload):
@@ -305,6 +1201,12 @@ def ev_pop():
 	return res
 
 
+def ev_peek():
+	with ev_mutex:
+		if len(ev_queue) < 1: return None
+		return ev_queue[0]
+
+
 def handle_stdin():
 	try:
 		while True:
@@ -314,36 +1216,148 @@ def handle_stdin():
 		ev_push(EV_TERMINATE, None)
 
 
+# output lines are drawn in frames of at most one per render_interval seconds.
+# at most render_backlog lines are kept between frames, older ones are dropped
+# and counted. identical consecutive lines are collapsed if render_collapse
+render_interval = 1 / 30
+render_backlog = 1000
+render_collapse = True
+
+
+class Renderer:
+	def __init__(s):
+		s.lines = deque()
+		s.dropped = 0
+		s.cond = threading.Condition()
+		s.thread = None
+
+	def push(s, ln):
+		ln = ln.rstrip()
+		with s.cond:
+			if render_collapse and len(s.lines) > 0 and s.lines[-1][0] == ln:
+				s.lines[-1][1] += 1
+				return
+			s.lines.append([ln, 1])
+			if render_backlog is not None and len(s.lines) > render_backlog:
+				s.lines.popleft()
+				s.dropped += 1
+			if s.thread is None:
+				s.thread = threading.Thread(target=s.run, daemon=True)
+				s.thread.start()
+			s.cond.notify()
+
+	def run(s):
+		while True:
+			with s.cond:
+				while len(s.lines) < 1 and s.dropped < 1:
+					s.cond.wait()
+			s.flush()
+			time.sleep(render_interval)
+
+	def flush(s):
+		import readline
+		with s.cond:
+			lines, s.lines = s.lines, deque()
+			dropped, s.dropped = s.dropped, 0
+		frame = list()
+		if dropped > 0:
+			frame.append(f"[\x1b[33;1m...\x1b[30;0m]{dropped} lines dropped")
+		for ln, count in lines:
+			frame.append(ln if count < 2 else f"{ln} \x1b[2m(x{count})\x1b[0m")
+		if len(frame) < 1: return
+		# one prompt redraw per frame instead of one per line
+		sys.stdout.write(f"\x1b6n\x1b[u\x1b[0J\r" + "\n\r".join(frame) +
+		                 f"\n\r\x1b[s>{readline.get_line_buffer()}")
+		sys.stdout.flush()
+
+
+renderer = Renderer()
+
+
 def println(ln):
-	sys.stdout.write(
-	  f"\x1b6n\x1b[u\x1b[0J\r{ln.rstrip()}\n\r\x1b[s>{readline.get_line_buffer()}"
-	)
-	# sys.stdout.write(f"\x1b[s\r{ln.rstrip()}\n\r\x1b[u")
+	renderer.push(ln)
 
 
 def on_connect(client, userdata, flags, rc):
-	client.subscribe("/unicorn/idl/#")
+	if rc != 0: return
+	userdata.online.set()
+	client.subscribe([(topic, 0) for topic in idl_filters(userdata)])
+	with ev_mutex:
+		# clean sessions drop everything on reconnect, restore the response
+		# channels of the command still in flight
+		if topic_broker is userdata:
+			for topic in (topic_stdout, topic_stderr, topic_result):
+				if topic is not None:
+					client.subscribe(topic)
+		if len(userdata.pending) > 0:
+			ev_push(EV_BROKER_CONNECTED, userdata)
+	with fanout_cond:
+		topics = [(topic, 0) for name, topic in fanout_topics
+		          if name == userdata.name]
+	if len(topics) > 0:
+		client.subscribe(topics)
+	idl_touch()
+
+
+def on_disconnect(client, userdata, rc):
+	userdata.online.clear()
+	mqtt_mid_pool_reset(userdata.name)
+
+
+def idl_parser_get():
+	global idl_parser
+	with idl_activity_cond:
+		if idl_parser is None:
+			idl_parser = idl.ParserPool(on_idl_parsed, workers=idl_workers)
+	return idl_parser
+
+
+def on_idl_message(userdata, msg):
+	try:
+		raw = msg.payload.decode()
+	except UnicodeDecodeError as e:
+		return False
+	# every reconnect replays all retained IDLs. skip the ones we already know
+	# so a flapping link does not parse and rebuild the grammar over and over
+	known = idl_sources.get(msg.topic[13:], dict()).get(userdata.name, None)
+	if known is not None and known._json == raw:
+		return False
+	# parsing and validating is left to the worker pool, so a retained burst
+	# does not stall this network thread
+	idl_parser_get().submit(msg.topic[13:], raw, tag=userdata.name)
+	return True
+
+
+def on_idl_parsed(topic, l, error, broker):
+	try:
+		if error is not None:
+			print(error)
+		elif l is not None:
+			if demand_mode:
+				demand_stage(broker, l)
+			ev_push(EV_IDL_CONFIG, (broker, l))
+	finally:
+		demand_end(topic.split("/")[0])
+		idl_touch()
 
 
 def on_message(client, userdata, msg):
-	if msg.topic.startswith("/unicorn/idl/"):
-		try:
-			data = json.loads(msg.payload.decode())
-		except (UnicodeDecodeError, json.JSONDecodeError) as e:
-			return
-		if not "completion" in data: return
-		try:
-			ev_push(EV_IDL_CONFIG, idl.IDL.FromJSON(msg.topic[13:], data))
-		except jsonschema.exceptions.ValidationError as e:
-			print(f"invalid IDL for topic {msg.topic[13:]}")
-			print(json.dumps(data, indent='  '))
-			print(e)
-			return
-		except Exception as e:
-			print(msg.topic)
-			traceback.print_exc()
-			return
-
+	if msg.topic.startswith("/unicorn/active/"):
+		device = msg.topic[16:].split("/")[0]
+		if len(device) < 1 or not device_in_scope(device): return
+		ev_push(EV_ACTIVE, (userdata.name, device, len(msg.payload) > 0))
+		idl_touch()
+
+	elif msg.topic.startswith("/unicorn/idl/"):
+		idl_touch()
+		if not in_scope(msg.topic[13:]): return
+		device = msg.topic[13:].split("/")[0]
+		demand_begin(device)
+		if not on_idl_message(userdata, msg):
+			demand_end(device)
+
+	elif (userdata.name, msg.topic) in fanout_topics:
+		fanout_deliver(userdata.name, msg)
 	elif msg.topic == topic_stdout:
 		for ln in msg.payload.decode().rstrip().splitlines():
 			println("[\x1b[32;1mout\x1b[30;0m]" + ln.rstrip())
@@ -358,16 +1372,19 @@ def on_message(client, userdata, msg):
 
 
 def on_subscribe(client, userdata, mid, granted_qos):
-	mqtt_mid_pool_add(mid)
+	mqtt_mid_pool_add((userdata.name, mid))
 
 
 def run(mqtt_host="mqtt",
         mqtt_port=1883,
         mqtt_proxy=None,
         fn_history=None,
-        fn_cache=None):
-	if fn_cache is not None and os.path.exists(fn_cache):
-		load_cache(fn_cache)
+        fn_cache=None,
+        brokers=None,
+        scopes=None,
+        on_demand=False):
+	configure(mqtt_host, mqtt_port, mqtt_proxy, fn_cache, brokers, scopes,
+	          on_demand)
 
 	if True: # command-line argument handling
 
@@ -375,6 +1392,11 @@ def run(mqtt_host="mqtt",
 
 		fNonInteractive = False
 		fPrintDMenuTree = False
+		fCached = False
+		dmenu_idle = 0.5
+		cli_timeout = None
+		cli_brokers = list()
+		cli_scopes = list()
 
 		class clex(Exception):
 			pass
@@ -385,17 +1407,38 @@ def run(mqtt_host="mqtt",
 					print_help(sys.stdout)
 					sys.exit(0)
 				elif arg in {"--options"}:
-					cmdline_str = " ".join([shlex.quote(v) for v in command_line]) + " "
-
-					try:
-						toks = autocomplete.TokenStream(cmdline_str, len(cmdline_str))
-						print(" ".join(shlex.quote(v) for v in lang.complete(toks)))
-					except SyntaxError as e:
-						pass
+					if fn_cache is not None and os.path.exists(fn_cache):
+						load_cache(fn_cache)
+					options.print_options(command_line, sys.stdout)
 					exit(0)
 				elif arg in {"--dmenu-tree"}:
 					fPrintDMenuTree = True
 					pass
+				elif arg.startswith("--dmenu-idle="):
+					try:
+						dmenu_idle = float(arg[13:])
+					except ValueError:
+						raise clex(f"invalid idle interval: {arg[13:]}")
+				elif arg in {"--cached"}:
+					fCached = True
+				elif arg.startswith("--broker="):
+					cli_brokers.append(arg[9:])
+				elif arg.startswith("--scope="):
+					cli_scopes.append(arg[8:])
+				elif arg.startswith("--idl-workers="):
+					global idl_workers
+					try:
+						idl_workers = int(arg[14:])
+					except ValueError:
+						raise clex(f"invalid worker count: {arg[14:]}")
+				elif arg in {"--on-demand"}:
+					global demand_mode
+					demand_mode = True
+				elif arg.startswith("--timeout="):
+					try:
+						cli_timeout = float(arg[10:])
+					except ValueError:
+						raise clex(f"invalid timeout: {arg[10:]}")
 				elif arg == "--":
 					command_line += sys.argv[i_arg + 2:]
 					fNonInteractive = True
@@ -408,11 +1451,30 @@ def run(mqtt_host="mqtt",
 			sys.stderr.write("\x1b[31;1mError\x1b[30;0m: %s\n" % e)
 			return 1
 
+		if len(cli_brokers) > 0:
+			set_brokers(cli_brokers)
+		if cli_timeout is not None:
+			global fanout_timeout
+			fanout_timeout = cli_timeout
+		if len(cli_scopes) > 0:
+			set_scopes(cli_scopes)
+
+	# load the cache once the scopes are known
+	if fn_cache is not None and os.path.exists(fn_cache):
+		load_cache(fn_cache)
+
+	if fPrintDMenuTree and fCached:
+		print_dmenu_tree(sys.stdout)
+		return 0
+
 	if fNonInteractive:
+		if len(command_line) > 0 and command_line[0].startswith("@"):
+			return run_fanout(command_line, dmenu_idle)
 		if len(command_line) > 0:
-			process_command(None, " ".join([shlex.quote(v) for v in command_line]))
+			process_command(None, join_command_line(command_line))
 		return 0
 
+	import readline
 	readline.set_completer(completer)
 	readline.set_completer_delims(" \t")
 	readline.parse_and_bind("tab: complete")
@@ -422,62 +1484,18 @@ def run(mqtt_host="mqtt",
 		readline.read_history_file(fn_history)
 
 	global mqtt_client
-	mqtt_client = mqtt.Client()
-	if mqtt_proxy is not None:
-		# set proxy ONLY after client build but after connect
-		socks.setdefaultproxy(socks.PROXY_TYPE_SOCKS4, *mqtt_proxy)
-		socket.socket = socks.socksocket
-	mqtt_client.on_connect = on_connect
-	mqtt_client.on_message = on_message
-	mqtt_client.on_subscribe = on_subscribe
-	mqtt_client.connect(mqtt_host, mqtt_port, 60)
-
-	thrd_mqtt = threading.Thread(target=mqtt_client.loop_forever, daemon=True)
-	thrd_mqtt.start()
+	start_brokers()
+	mqtt_client = broker_for(None).client
 
 	if fPrintDMenuTree:
 
-		def printDMenuTree():
-			def rec(node, handled=set(), cmdline=list()):
-				if node in handled: return ""
-				handled.add(node)
-				res = ""
-				if node is None or isinstance(node, autocomplete.Empty):
-					raw = decode_command(shlex.join(cmdline))
-					if raw is not None:
-						prefix, topic, payload, suffix = raw
-						res = ":output " + shlex.join(("mosquitto_pub", "-h", "mqtt", "-t",
-						                               topic, "-m", payload)) + "\n"
-
-				elif isinstance(node, autocomplete.Keyword):
-					for k, v in node._stmts.items():
-						sub = rec(v, handled, cmdline + [k])
-						if sub is not None and len(sub) > 0:
-							res += k + "\n" + sub
-					if len(res) > 0 and len(cmdline) > 0:
-						res = f":push\n{res}:pop\n"
-
-				elif isinstance(node, autocomplete.Sequence):
-					pass
-				elif isinstance(node, autocomplete.Repeat):
-					pass
+		def waitDMenuTree():
+			connected = wait_any_connected(suback_timeout)
+			if connected:
+				idl_wait_idle(dmenu_idle)
+			ev_push(EV_DMENU_TREE, connected)
 
-				elif isinstance(node, (autocomplete.Number, autocomplete.String)):
-					pass
-				else:
-					pass
-				return res
-
-			try:
-				time.sleep(1)
-				print(rec(lang))
-			except Exception as e:
-				print(e)
-				traceback.print_exception(e)
-			finally:
-				ev_push(EV_TERMINATE, None)
-
-		thrd_fin = threading.Thread(target=printDMenuTree, daemon=True)
+		thrd_fin = threading.Thread(target=waitDMenuTree, daemon=True)
 		thrd_fin.start()
 	else:
 		thrd_stdin = threading.Thread(target=handle_stdin, daemon=True)
@@ -490,6 +1508,7 @@ def run(mqtt_host="mqtt",
 
 	signal.signal(signal.SIGINT, interrupted)
 
+	res = 0
 	while True:
 		ev = ev_pop()
 		if ev.kind == EV_TERMINATE:
@@ -502,7 +1521,45 @@ def run(mqtt_host="mqtt",
 		elif ev.kind == EV_IDL_STDERR:
 			sys.stderr.write(ev.payload + "\n")
 			sys.stderr.flush()
-		elif ev.kind == EV_IDL_CONFIG:
-			topic_idl_map[ev.payload.topic] = ev.payload
-			build_lang(write_cache=False)
+		elif ev.kind in {EV_IDL_CONFIG, EV_ACTIVE}:
+			if ev.kind == EV_IDL_CONFIG:
+				apply_idl(*ev.payload)
+			else:
+				apply_active(*ev.payload)
+			# coalesce bursts of IDL updates into a single rebuild
+			nxt = ev_peek()
+			if nxt is None or nxt.kind not in {EV_IDL_CONFIG, EV_ACTIVE}:
+				build_lang(write_cache=False)
+		elif ev.kind == EV_BROKER_CONNECTED:
+			for deadline, cmdline in ev.payload.take_pending():
+				process_command(mqtt_client, cmdline, deadline)
+		elif ev.kind == EV_EXPIRED:
+			broker, expired, deadline = ev.payload
+			for cmdline in expired:
+				println(f"[\x1b[31;1merr\x1b[30;0m]command timed out: {cmdline}")
+			# a later command may have replaced the topics in the meantime
+			if deadline is not None and topic_broker is broker \
+			  and topic_deadline == deadline:
+				setResponseTopics(None, None, None)
+				println(f"[\x1b[31;1merr\x1b[30;0m]no result from {broker.name} "
+				        f"within {command_timeout:g}s")
+		elif ev.kind == EV_DMENU_TREE:
+			if not ev.payload:
+				sys.stderr.write("\x1b[33;1mwarning\x1b[30;0m: no broker reachable within "
+				                 f"{suback_timeout:g}s, using the cached IDLs\n")
+				if len(topic_idl_map) < 1:
+					res = 1
+			import traceback
+			try:
+				print_dmenu_tree(sys.stdout)
+			except Exception as e:
+				print(e)
+				traceback.print_exception(e)
+			break
+	renderer.flush()
+	if idl_parser is not None:
+		idl_parser.close()
+	if fn_cache is not None:
+		write_cache_file(fn_cache)
 	readline.write_history_file(fn_history)
+	return res
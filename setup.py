@@ -7,12 +7,12 @@ setup(
   version='0.2',
   packages=find_packages(where='py'),
   package_dir={'': 'py'},
-  extras_require={},
+  extras_require={'rollup': ['numpy']},
   install_requires=[],
   url='https://github.com/wagenerp/unicorn',
   maintainer='Peter Wagener',
   maintainer_email='mail@peterwagener.net',
-  python_requires='>=3.5',
+  python_requires='>=3.7',
   classifiers=[
         "Development Status :: 3 - Alpha",
         "Intended Audience :: Developers",